@@ -1,3 +1,6 @@
+import sys
+import types
+from contextlib import contextmanager
 from params import *
 import numpy as np
 
@@ -31,6 +34,27 @@ def CLAUSIUS_CLAPEYRON(Ts, Ta):
     return esat, qsat
 
 
+def CLAUSIUS_CLAPEYRON_ARRAY(Ts, Ta):
+    ''' As CLAUSIUS_CLAPEYRON, for arrays of temperatures (e.g. one per box).'''
+
+    # Average of atmospheric and surface temperatures
+    Tsa = 0.5*(Ts + Ta)
+
+    Ts = np.maximum(Tsa, 35.0)
+    Tc = Tsa - 273.15
+    denom = 243.5 + Tc
+    eps = 0.62197 # RD/RV
+
+    # Satu. vap. pressure for liquid water where Tc >= 0, otherwise for ice (mb)
+    esat = np.where(Tc >= 0, 6.112 * np.exp(17.67 * Tc/denom),
+                    np.exp(23.33086 - 6111.72784/Ts + 0.15215*np.log(Ts)))
+
+    # Saturation specific humidity at TS, PS
+    qsat = eps * esat/(PA - esat * (1-eps))
+
+    return esat, qsat
+
+
 def EPSA(esat, qsat, co2):
     ''' Computes emissivity of atmospheric column    
         at average atmos. temperature Ta (K), surface temperature Ts (K),
@@ -90,7 +114,7 @@ def FS(Ts, Ta, Te, epsa):
     
     # Evaporation
     if Ts-Ta > DTCRIT_CONV:
-        Feva = BIGONE * (1 + 0.05*np.random.normal()) * (Ts - Ta - DTCRIT_CONV)
+        Feva = BIGONE * (1 + FEVA_NOISE*np.random.normal()) * (Ts - Ta - DTCRIT_CONV)
     else: 
         Feva = 0
     
@@ -100,6 +124,26 @@ def FS(Ts, Ta, Te, epsa):
     return Fs, Feva
 
 
+def FS_ARRAY(Ts, Ta, Te, epsa, noise=None):
+    ''' As FS, for arrays of temperatures (e.g. one per box, or one per timestep).
+        The random numbers for the noise in the evaporation can be given
+        in 'noise', otherwise they're drawn for every element.'''
+
+    # Radiative surface flux
+    Frad = SIGMA * (Ts**4 - Te**4 - epsa*Ta**4)
+
+    # Evaporation, where convection is taking place
+    dT = Ts - Ta - DTCRIT_CONV
+    if noise is None:
+        noise = np.random.normal(size=np.shape(dT))
+    Feva = np.where(dT > 0, BIGONE * (1 + FEVA_NOISE*noise) * dT, 0.)
+
+    # Net surface heat flux
+    Fs = Frad + Feva
+
+    return Fs, Feva
+
+
 def FT(Ts, Ta, Te, epsa):
     ''' Calculates top-of-atmosphere fluxes.'''
     
@@ -122,3 +166,50 @@ def FO(Psio, Ts1, To2):
     Fo = Psio * CPO * (Ts1-To2) / (np.pi*RADIUS**2) # W m-2
     return Fo
 
+
+@contextmanager
+def overridden(module=None, **values):
+    ''' Within a with block, sets the constants (or other globals) 'values' of
+        'module', by default this one, e.g.
+
+            with calc.overridden(FEVA_NOISE=0.):
+                ...
+
+        Restores them afterwards, and the state of numpy's random numbers. '''
+
+    if module is None:
+        module = sys.modules[__name__]
+
+    missing = object()
+    previous = dict( (name, getattr(module, name, missing)) for name in values )
+    random_state = np.random.get_state()
+
+    for name, value in values.items():
+        setattr(module, name, value)
+
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is missing:
+                delattr(module, name)
+            else:
+                setattr(module, name, value)
+        np.random.set_state(random_state)
+
+
+def settable(*functions):
+    ''' Names of the constants which can be changed by setting them in this
+        module, for a model whose functions are 'functions' (e.g. model.update):
+        those used by the functions in this module but not by 'functions',
+        which use the copies imported from constants.py and params.py. '''
+
+    def names(functions):
+        return set( name for f in functions for name in f.__code__.co_names )
+
+    module = sys.modules[__name__]
+    used = names( f for f in vars(module).values()
+                  if isinstance(f, types.FunctionType) and f.__module__ == __name__ )
+
+    return set( name for name in used - names(functions)
+                if name.isupper() and not callable(getattr(module, name)) )
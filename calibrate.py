@@ -0,0 +1,232 @@
+import multiprocessing
+import numpy as np
+
+from constants import *
+from params import *
+import calculations as calc
+import model
+
+# Calibration of the two-box model: finds the values of constants from
+# constants.py which bring the equilibrium of a control simulation closest
+# to target values, by minimising a misfit with a derivative-free search.
+#
+# Run with
+#     python calibrate.py
+# after setting the targets and parameter ranges below. The simulations use
+# the settings in params.py (run them with CO2_increase = 'none'), and each
+# is stopped as soon as it has reached equilibrium, or after nyr years.
+
+# ------------------------- #
+#  Parameters to calibrate  #
+# ------------------------- #
+# (lowest, highest) value of each constant to search. Any constant used
+# directly by calculations.py, and not by model.py (which has its own copies
+# of the constants), can be calibrated: see model.settable().
+BOUNDS = {'KEFF': (20*SV/15, 300*SV/15),
+          'PSIFRAC': (0.02, 0.5),
+          'RHA': (0.3, 0.95),
+          'DTCRIT_CONV': (20., 60.)
+          }
+
+
+# --------- #
+#  Targets  #
+# --------- #
+# Equilibrium surface temperatures (K) and heat transports (PW)
+TARGETS = {'Ts1': 299., 'Ts2': 278., 'Fa': 4., 'Fo': 1.5}
+
+# Size of a misfit from each target which is as bad as 1 K in surface temperature
+SCALES = {'Ts1': 1., 'Ts2': 1., 'Fa': 0.25, 'Fo': 0.25}
+
+
+def misfit(eq):
+    """ Misfit of an equilibrium 'eq' (a dictionary of Ts1, Ts2, Fa, Fo)
+        from the targets. Replace this to calibrate against something else. """
+    return sum( ((eq[key] - TARGETS[key]) / SCALES[key])**2 for key in TARGETS )
+
+
+# --------------------- #
+#  Search and stopping  #
+# --------------------- #
+# Number of simulations run at once (by default one per processor)
+processes = multiprocessing.cpu_count()
+
+# The search stops after this many simulations, or once it's narrowed down
+# to this fraction of the ranges in BOUNDS
+max_evaluations = 200
+min_step = 1./64
+
+# Simulations are checked every check_years. They're in equilibrium once the
+# means over the last check_years differ from those over the previous
+# check_years by less than these tolerances (K, PW), and have diverged if a
+# surface temperature leaves Ts_range (K).
+check_years = 10
+TOLERANCES = {'Ts1': 0.01, 'Ts2': 0.01, 'Fa': 0.005, 'Fo': 0.005}
+Ts_range = (150., 400.)
+
+# Seed for the random noise in the evaporation. All simulations use the same
+# noise, so the misfit doesn't change between runs with the same parameters.
+seed = 0
+
+
+def equilibrate(values):
+    """ Run the two-box model with the constants in 'values' (a dictionary)
+        until it reaches equilibrium.
+
+        Returns (eq, years, status): the means of Ts1, Ts2 (K), Fa and Fo (PW)
+        over the last check_years, the number of years simulated, and one of
+        'converged', 'diverged' or 'not converged' (after nyr years). """
+
+    # Set the constants used by calculations.py, restoring them afterwards
+    with calc.overridden(**values):
+        np.random.seed(seed)
+        box1, box2, glob = model.initialise()
+
+        n_check = int(round( check_years*YEAR / dt ))
+        previous = None
+        eq = dict( (key, np.nan) for key in TOLERANCES )
+        status = 'not converged'
+
+        for n in range(nt):
+            model.update(n, box1, box2, glob)
+            model.step(n, box1, box2, glob)
+
+            if (n+1) % n_check != 0:
+                continue
+
+            # Means over the last check_years (rows which have been updated)
+            window = slice(n+1-n_check, n+1)
+            eq = {'Ts1': box1['Ts'][window].mean(),
+                  'Ts2': box2['Ts'][window].mean(),
+                  'Fa': glob['Fa'][window].mean() * np.pi*RADIUS**2 / PW,
+                  'Fo': glob['Fo'][window].mean() * np.pi*RADIUS**2 / PW
+                  }
+
+            Ts = (eq['Ts1'], eq['Ts2'])
+            if not np.all(np.isfinite(eq.values())) or min(Ts) < Ts_range[0] or max(Ts) > Ts_range[1]:
+                status = 'diverged'
+                break
+
+            if previous is not None and all( abs(eq[key] - previous[key]) < TOLERANCES[key] for key in TOLERANCES ):
+                status = 'converged'
+                break
+            previous = eq
+
+        years = (n+1) * dt / YEAR
+
+    return eq, years, status
+
+
+def _equilibrate(items):
+    """ equilibrate() for a list of (name, value) items, for Pool.map """
+    return equilibrate(dict(items))
+
+
+def calibrate(misfit=misfit, bounds=BOUNDS, processes=processes,
+              max_evaluations=max_evaluations, min_step=min_step):
+    """ Minimise misfit(eq) over the constants in 'bounds', where eq is the
+        equilibrium returned by equilibrate().
+
+        The search is a compass search in the parameters scaled to [0, 1]
+        by their bounds: each iteration runs a batch of simulations, one
+        step up and one step down in each parameter from the best point so
+        far, in parallel. It moves to the best of them if that improves the
+        misfit, and otherwise halves the step. The search starts from the
+        values in constants.py, with a step of a quarter of each range.
+        Only simulations which reach equilibrium are given a misfit (the
+        others' is infinite), so the best point is always an equilibrium
+        if any simulation reached one.
+
+        Returns a dictionary of
+            'best'          - the best values found of the constants
+            'misfit'        - the misfit of 'best' (inf if no simulation
+                              reached equilibrium)
+            'status'        - how the simulation of 'best' ended
+            'history'       - the best misfit after each iteration
+            'evaluations'   - the number of simulations run
+            'years'         - the total number of years simulated """
+
+    names = sorted(bounds)
+    ignored = [name for name in names if name not in model.settable()]
+    if ignored:
+        raise ValueError("Setting %s in calculations.py has no effect on the model" %", ".join(ignored))
+
+    lower = np.array([bounds[name][0] for name in names], dtype=float)
+    upper = np.array([bounds[name][1] for name in names], dtype=float)
+
+    def values(x):
+        return zip(names, lower + x*(upper-lower))
+
+    def evaluate(points):
+        """ Misfits of a batch of points, simulated in parallel """
+        results = mapper(_equilibrate, [values(x) for x in points])
+        totals['evaluations'] += len(points)
+        totals['years'] += sum(years for eq, years, status in results)
+        misfits = []
+        for x, (eq, years, status) in zip(points, results):
+            # Only equilibria count: the last years of other runs aren't one
+            misfits.append( misfit(eq) if status == 'converged' else np.inf )
+            statuses[tuple(x)] = status
+            print "  %s: misfit %.4g (%s after %d years)" \
+                    %(", ".join("%s=%.4g" %item for item in values(x)), misfits[-1], status, years)
+        return misfits
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        mapper = pool.map
+    else:
+        mapper = map
+    totals = {'evaluations': 0, 'years': 0.}
+    statuses = {}
+
+    try:
+        # Start from constants.py
+        x = np.clip( (np.array([getattr(calc, name) for name in names]) - lower) / (upper-lower), 0, 1)
+        print "Initial parameters"
+        best = evaluate([x])[0]
+        history = [best]
+        step = 0.25
+
+        while step >= min_step and totals['evaluations'] < max_evaluations:
+            # One step either way in each parameter, within the bounds
+            points = []
+            for i in range(len(names)):
+                for sign in (1, -1):
+                    point = x.copy()
+                    point[i] = np.clip(point[i] + sign*step, 0, 1)
+                    if point[i] != x[i] and not any(np.array_equal(point, p) for p in points):
+                        points.append(point)
+            points = points[:max_evaluations - totals['evaluations']]
+
+            print "Iteration %d (step %.3g)" %(len(history), step)
+            misfits = evaluate(points)
+
+            i = int(np.argmin(misfits))
+            if misfits[i] < best:
+                x, best = points[i], misfits[i]
+            else:
+                step *= 0.5
+            history.append(best)
+
+    finally:
+        if processes > 1:
+            pool.close()
+            pool.join()
+
+    return {'best': dict(values(x)), 'misfit': best, 'status': statuses[tuple(x)], 'history': history,
+            'evaluations': totals['evaluations'], 'years': totals['years']}
+
+
+if __name__ == "__main__":
+
+    result = calibrate()
+
+    print "\nBest parameters (misfit %.4g, %s):" %(result['misfit'], result['status'])
+    for name in sorted(result['best']):
+        print "  %s = %.6g (was %.6g)" %(name, result['best'][name], getattr(calc, name))
+
+    print "\nMisfit after each iteration:"
+    print "  " + ", ".join("%.4g" %value for value in result['history'])
+
+    print "\n%d simulations, %d years simulated (%d without stopping at equilibrium)" \
+            %(result['evaluations'], result['years'], result['evaluations']*nyr)
@@ -47,6 +47,7 @@ HCA = CAHEAT*PATM/GRAVI     # Atmospheric heat capacity (J K-1 m-2)
 DTCRIT_CONV = 40.   # Moist adiabatic lapse rate (K)
 PSIFRAC = 0.1       # Ratio PSIo/PSIa of circulation intensity
 BIGONE = 100.
+FEVA_NOISE = 0.05   # Amplitude of random noise in evaporation (relative)
 KEFF = 100*SV/15    # Linear parameterisation
 
 # ----------- #
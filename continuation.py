@@ -0,0 +1,511 @@
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+
+from constants import *
+from params import *
+import calculations as calc
+import nbox
+
+# The two-box model described in the documentation, or the N-box version
+model = nbox.selected()
+
+# Equilibria of the model as a parameter (by default the CO2 concentration)
+# varies, found by following the branch of steady states through the range
+# of the parameter with pseudo-arclength continuation, rather than running
+# the model to equilibrium for each value. Along the way it finds
+#     folds      - where the branch turns back on itself, so that there's
+#                  more than one equilibrium for the same parameter and the
+#                  model shows hysteresis
+#     regimes    - where a box starts or stops convecting (Ts - Ta > DTCRIT_CONV,
+#                  see calculations.FS)
+#     stability  - changes in the stability of the equilibria (other than at folds)
+#
+# The equilibria are the steady states of the tendencies of model.step,
+# without the random noise in the evaporation (for the N-box model, of the
+# explicit integrator, which has the same steady states). The branch starts
+# from the equilibrium at the first value of the parameter, found from the
+# initial conditions in params.py.
+#
+# Run with
+#     python continuation.py
+# The events along the branch are printed, and saved with the whole branch
+# and the bifurcation diagram to save_loc/continuation.txt and
+# save_loc/continuation.pdf.
+
+# ----------- #
+#  Parameter  #
+# ----------- #
+# 'CO2' (ppm), or any constant used directly by calculations.py and not by
+# the model itself, which has its own copies (see model.settable())
+parameter = 'CO2'
+
+# Values to follow the branch between, from the first to the second
+parameter_range = (CO2_init, 8*CO2_init)
+
+
+# -------------- #
+#  Continuation  #
+# -------------- #
+# Steps along the branch are measured in K of temperature, with the whole
+# parameter range counting as 'span' K
+span = 20.
+
+# First, smallest and largest step. The step is halved when the corrector
+# doesn't converge, and increased after it converges quickly.
+ds = 0.2
+ds_min = 1e-4
+ds_max = 2.
+
+# Most equilibria found
+max_points = 2000
+
+# Newton's method: the corrections (K) it stops at, and the iterations before
+# it's given up and the step halved
+tolerance = 1e-8
+max_iterations = 8
+
+# Variables in the bifurcation diagram, and the factors converting them to the
+# units shown (by default the surface temperatures of the boxes nearest the
+# equator and the pole, and the atmospheric circulation between them)
+if n_boxes == 2:
+    PLOTTED = (('box1.Ts', 1., "K"), ('box2.Ts', 1., "K"), ('glob.Psia', 1./SV, "$10^9$ kg/s"))
+else:
+    PLOTTED = (('Ts_0', 1., "K"), ('Ts_%d' %(n_boxes-1), 1., "K"), ('Psia_0', 1./SV, "$10^9$ kg/s"))
+
+
+class Tendencies(object):
+    """ Tendencies of the temperatures in each box, as stepped forward by
+        model.step, for any temperatures and value of the parameter. Uses a
+        state array of just two rows: the temperatures are put in the first,
+        and the tendencies are the difference from the second after a step. """
+
+    def __init__(self, parameter=parameter):
+        self.parameter = parameter
+
+        previous_nt = model.nt
+        model.nt = 1
+        try:
+            self.data = model.initialise()
+        finally:
+            model.nt = previous_nt
+
+        self.state = self.data[0]['Ta'].base
+        self.columns = nbox.state_columns(n_boxes)
+        self.cols = [col for col, name in enumerate(self.columns)
+                        if name.split('.')[-1].split('_')[0] in ('Ta', 'Ts', 'To')]
+
+        # Columns of Ta and Ts in each box, for the convective regime
+        self.Ta_cols = [col for col in self.cols if self.columns[col].split('.')[-1].split('_')[0] == 'Ta']
+        self.Ts_cols = [col for col in self.cols if self.columns[col].split('.')[-1].split('_')[0] == 'Ts']
+
+    def initial(self):
+        """ Temperatures of the initial conditions """
+        return self.state[0, self.cols].copy()
+
+    def set(self, x, p):
+        """ Set the temperatures to 'x' and the parameter to 'p', and update the other variables """
+
+        if self.parameter == 'CO2':
+            self.data[-1]['CO2'][0] = p
+        else:
+            setattr(calc, self.parameter, p)
+        self.state[0, self.cols] = x
+        model.update(0, *self.data)
+
+    def __call__(self, x, p):
+        """ Tendencies (K/s) at temperatures 'x' and parameter 'p' """
+
+        self.set(x, p)
+        model.step(0, *self.data)
+
+        return (self.state[1, self.cols] - x) / dt
+
+    def jacobian(self, x, p):
+        """ Derivatives of the tendencies at (x, p) with respect to each
+            temperature (a matrix) and to the parameter (a vector), by finite
+            differences. Returns them with the tendencies. """
+
+        f = self(x, p)
+        J = np.zeros( (len(x), len(x)) )
+        for k in range(len(x)):
+            h = 1e-8 * max(1., abs(x[k]))
+            xh = x.copy()
+            xh[k] += h
+            J[:,k] = (self(xh, p) - f) / h
+
+        h = 1e-8 * max(1., abs(p))
+        Jp = (self(x, p + h) - f) / h
+
+        return J, Jp, f
+
+    def row(self, x, p):
+        """ The row of the state array at (x, p), and how far each box is
+            from convecting (Ts - Ta - DTCRIT_CONV, K) """
+
+        self.set(x, p)
+        margin = self.state[0, self.Ts_cols] - self.state[0, self.Ta_cols] - calc.DTCRIT_CONV
+
+        return self.state[0].copy(), margin
+
+
+def equilibrium(f, x, p, max_steps=200):
+    """ The equilibrium of the tendencies 'f' (a Tendencies) at parameter 'p'
+        nearest to temperatures 'x', by pseudo-transient continuation: implicit
+        time steps which grow (to Newton's method) as the tendencies shrink.
+        Returns None if it isn't found. """
+
+    tau = dt
+    residual = np.inf
+    for k in range(max_steps):
+        J, Jp, tend = f.jacobian(x, p)
+        step = np.linalg.solve(np.eye(len(x))/tau - J, tend)
+        x = x + step
+
+        norm = np.max(np.abs(tend))
+        tau = tau*2 if norm < residual else tau/4
+        residual = norm
+
+        if not np.all(np.isfinite(x)):
+            return None
+        if np.max(np.abs(step)) < tolerance and tau > YEAR:
+            return x
+
+    return None
+
+
+class Arclength(object):
+    """ Steps along the branch of equilibria of the tendencies 'f', in
+        u = (temperatures, scaled parameter), where the scaled parameter l
+        gives the parameter p0 + scale*l """
+
+    def __init__(self, f, p0, scale):
+        self.f = f
+        self.p0 = p0
+        self.scale = scale
+
+    def parameter(self, u):
+        return self.p0 + self.scale*u[-1]
+
+    def derivatives(self, u):
+        """ (Jacobian with respect to the temperatures and the scaled parameter,
+            Jacobian with respect to just the temperatures, tendencies) at u """
+        J, Jp, tend = self.f.jacobian(u[:-1], self.parameter(u))
+        return np.column_stack( (J, Jp*self.scale) ), J, tend
+
+    def tangent(self, u, direction):
+        """ Unit tangent to the branch at u, pointing the same way as
+            'direction', and the Jacobian with respect to the temperatures """
+
+        D, J, tend = self.derivatives(u)
+        e = np.zeros(len(u))
+        e[-1] = 1.
+        t = np.linalg.solve(np.vstack( (D, direction) ), e)
+
+        return t / np.linalg.norm(t), J
+
+    def step(self, u, t, ds):
+        """ The equilibrium a step ds along the branch from u, with tangent t:
+            predicted along the tangent and corrected with Newton's method,
+            keeping it on the plane through the prediction normal to the
+            tangent. Returns it with the number of iterations taken, or None
+            if Newton's method doesn't converge. """
+
+        predicted = u + ds*t
+        v = predicted.copy()
+        for iteration in range(max_iterations):
+            D, J, tend = self.derivatives(v)
+            correction = np.linalg.solve(np.vstack( (D, t) ), -np.append(tend, np.dot(t, v - predicted)))
+            v += correction
+            if not np.all(np.isfinite(v)):
+                break
+            if np.max(np.abs(correction)) < tolerance:
+                return v, iteration
+
+        return None, max_iterations
+
+
+def continuation(parameter=parameter, parameter_range=parameter_range, ds=ds):
+    """ Follow the branch of equilibria through parameter_range.
+
+        Returns a dictionary of
+            parameter   - value of the parameter at each equilibrium found
+            state       - (equilibrium, column) rows of the state array
+            columns     - names of the columns
+            convecting  - (equilibrium, box) whether each box is convecting
+            growth      - largest growth rate (real part of an eigenvalue of
+                          the Jacobian, 1/year): the equilibrium is stable if < 0
+            tangent     - d(parameter)/d(arclength), which changes sign at folds
+            events      - list of (kind, value of the parameter, description)
+            stopped     - why the continuation stopped """
+
+    if parameter != 'CO2' and parameter not in model.settable():
+        raise ValueError("Setting %s in calculations.py has no effect on the model" %parameter)
+
+    p0, p1 = float(parameter_range[0]), float(parameter_range[1])
+
+    # Switch off the noise, and keep the parameter, integrator and random
+    # numbers as they were
+    settings = {'FEVA_NOISE': 0.}
+    if parameter != 'CO2':
+        settings.setdefault(parameter, getattr(calc, parameter))
+    with calc.overridden(**settings), calc.overridden(nbox, implicit_atm=False):
+        f = Tendencies(parameter)
+        arc = Arclength(f, p0, (p1 - p0)/span)
+
+        x = equilibrium(f, f.initial(), p0)
+        if x is None:
+            raise ValueError("No equilibrium found from the initial conditions at %s = %g" %(parameter, p0))
+
+        # Start towards p1
+        u = np.append(x, 0.)
+        t, J = arc.tangent(u, np.eye(len(u))[-1])
+
+        # Each equilibrium with its tangent and Jacobian, and the steps between them
+        points = []
+        steps = []
+        stopped = "reached the end of the range"
+        while True:
+            points.append( (u, t, J) )
+
+            if not 0 < u[-1] < span and len(points) > 1:
+                break
+            if len(points) >= max_points:
+                stopped = "found max_points equilibria"
+                break
+
+            v, iterations = arc.step(u, t, ds)
+            while v is None and ds/2 >= ds_min:
+                ds /= 2
+                v, iterations = arc.step(u, t, ds)
+            if v is None:
+                stopped = "the step became smaller than ds_min at %s = %g" %(parameter, arc.parameter(u))
+                break
+            step = ds
+
+            # Longer steps while it converges quickly
+            if iterations < 3:
+                ds = min(2*ds, ds_max)
+
+            # Past the end of the range (or back past its start), finish with
+            # the equilibrium at the end
+            if not 0 <= v[-1] <= span:
+                end = span if v[-1] > span else 0.
+                fraction = (end - u[-1]) / (v[-1] - u[-1])
+                x = _newton(f, u[:-1] + fraction*(v[:-1] - u[:-1]), arc.parameter([end]))
+                if x is None:
+                    stopped = "the equilibrium at the end of the range wasn't found"
+                    break
+                v = np.append(x, end)
+                step *= fraction
+
+            t, J = arc.tangent(v, t)
+            steps.append(step)
+            u = v
+
+        branch = _describe(arc, points)
+        branch['events'] = events(arc, points, steps)
+        branch['stopped'] = stopped
+
+    return branch
+
+
+def _describe(arc, points):
+    """ The branch (see continuation) from the equilibria found along it """
+
+    rows, margins = zip(*[arc.f.row(u[:-1], arc.parameter(u)) for u, t, J in points])
+
+    return {'parameter': np.array( [arc.parameter(u) for u, t, J in points] ),
+            'state': np.array(rows),
+            'columns': arc.f.columns,
+            'convecting': np.array(margins) > 0,
+            'growth': np.array( [_growth(u, t, J) for u, t, J in points] ),
+            'tangent': np.array( [t[-1] * arc.scale for u, t, J in points] )}
+
+
+def _newton(f, x, p):
+    """ The equilibrium of the tendencies 'f' at parameter 'p' found by
+        Newton's method from 'x', or None if it doesn't converge """
+
+    for iteration in range(max_iterations):
+        J, Jp, tend = f.jacobian(x, p)
+        correction = np.linalg.solve(J, -tend)
+        x = x + correction
+        if not np.all(np.isfinite(x)):
+            return None
+        if np.max(np.abs(correction)) < tolerance:
+            return x
+
+    return None
+
+
+# Quantities which change sign at each kind of event, given an equilibrium
+# u, its tangent t and Jacobian J (and the Arclength and the box for regimes)
+def _turning(u, t, J):
+    """ Direction of the branch in the parameter """
+    return t[-1]
+
+def _growth(u, t, J):
+    """ Largest growth rate of perturbations (1/year) """
+    return np.max(np.linalg.eigvals(J).real) * YEAR
+
+def _margin(u, t, J, arc, box):
+    """ How far 'box' is from convecting (K) """
+    return arc.f.row(u[:-1], arc.parameter(u))[1][box]
+
+
+def _locate(arc, start, step, quantity, *args):
+    """ The equilibrium between 'start' (an equilibrium, tangent and Jacobian)
+        and the one 'step' along the branch from it at which quantity(u, t, J,
+        *args) changes sign, by bisecting the step. Returns the equilibrium,
+        its tangent and Jacobian. """
+
+    u, t, J = start
+    q_start = quantity(u, t, J, *args)
+
+    low, high = 0., step
+    found = start
+    for iteration in range(50):
+        if high - low < 1e-10*step:
+            break
+        # Newton's method can fail right at a kink in the tendencies (where a
+        # box starts convecting), so try either side of the middle too
+        for fraction in (0.5, 0.3, 0.7, 0.1, 0.9):
+            middle = low + fraction*(high - low)
+            v, iterations = arc.step(u, t, middle)
+            if v is not None:
+                break
+        if v is None:
+            break
+        tv, Jv = arc.tangent(v, t)
+        found = (v, tv, Jv)
+        if (quantity(v, tv, Jv, *args) > 0) == (q_start > 0):
+            low = middle
+        else:
+            high = middle
+
+    return found
+
+
+def events(arc, points, steps):
+    """ Folds, changes of convective regime and of stability between
+        consecutive equilibria (each an equilibrium, tangent and Jacobian),
+        given the steps along the branch between them. Each is found by
+        bisecting the step. Returns a list of (kind, parameter, description). """
+
+    f = arc.f
+    box_names = [f.columns[col].split('.')[0] if n_boxes == 2 else "box " + f.columns[col].split('_')[1]
+                 for col in f.Ts_cols]
+
+    found = []
+    for k in range(1, len(points)):
+        before, after = points[k-1], points[k]
+        changes = []
+
+        if (_turning(*before) > 0) != (_turning(*after) > 0):
+            u, t, J = _locate(arc, before, steps[k-1], _turning)
+            stability = "stable to unstable" if _growth(*before) < 0 <= _growth(*after) \
+                            else "unstable to stable" if _growth(*after) < 0 <= _growth(*before) \
+                            else "no change in stability"
+            changes.append( (u, ('fold', arc.parameter(u), "branch turns back (%s)" %stability)) )
+
+        for b in range(len(f.Ts_cols)):
+            if (_margin(*before + (arc, b)) > 0) != (_margin(*after + (arc, b)) > 0):
+                u, t, J = _locate(arc, before, steps[k-1], _margin, arc, b)
+                changes.append( (u, ('regime', arc.parameter(u), "%s %s convecting"
+                                     %(box_names[b], "starts" if _margin(*after + (arc, b)) > 0 else "stops"))) )
+
+        if (_growth(*before) < 0) != (_growth(*after) < 0) and not any(kind == 'fold' for u, (kind, p, d) in changes):
+            u, t, J = _locate(arc, before, steps[k-1], _growth)
+            eigenvalues = np.linalg.eigvals(J)
+            oscillating = np.any(eigenvalues.imag[eigenvalues.real == np.max(eigenvalues.real)] != 0)
+            changes.append( (u, ('stability', arc.parameter(u), "%s (%s)"
+                                 %("becomes unstable" if _growth(*after) >= 0 else "becomes stable",
+                                   "oscillatory, Hopf" if oscillating else "real eigenvalue"))) )
+
+        # In the order they're passed along the branch
+        before_u = before[0]
+        changes.sort(key=lambda change: np.linalg.norm(change[0] - before_u))
+        found += [event for u, event in changes]
+
+    return found
+
+
+def table(branch):
+    """ Lines listing each equilibrium of a branch: the parameter, the plotted
+        variables, which boxes are convecting and whether it's stable """
+
+    cols = [branch['columns'].index(name) for name, factor, units in PLOTTED]
+    header = "%14s " %parameter + " ".join("%14s" %name for name, factor, units in PLOTTED) \
+                + " %12s %8s" %("convecting", "stable")
+    lines = [header]
+    for k in range(len(branch['parameter'])):
+        lines.append( "%14.6g " %branch['parameter'][k]
+                      + " ".join("%14.6g" %(branch['state'][k,col] * factor) for col, (name, factor, units) in zip(cols, PLOTTED))
+                      + " %12s %8s" %("".join("y" if c else "n" for c in branch['convecting'][k]),
+                                      "yes" if branch['growth'][k] < 0 else "no") )
+
+    return lines
+
+
+def diagram(branch):
+    """ The bifurcation diagram of a branch: the plotted variables against
+        the parameter, solid where the equilibria are stable and dashed
+        where they're unstable, with the folds and changes of regime marked """
+
+    p = branch['parameter']
+    stable = branch['growth'] < 0
+
+    fig, axes = plt.subplots(len(PLOTTED), 1, sharex='all', squeeze=False, figsize=(6, 2.5*len(PLOTTED)))
+    axes = axes[:,0]
+    fig.suptitle("Equilibria against %s" %parameter)
+
+    for ax, (name, factor, units) in zip(axes, PLOTTED):
+        values = branch['state'][:, branch['columns'].index(name)] * factor
+
+        # Each stretch of the branch with the same stability, joined to the next
+        start = 0
+        for k in range(1, len(p) + 1):
+            if k == len(p) or stable[k] != stable[start]:
+                stretch = slice(start, min(k+1, len(p)))
+                ax.plot(p[stretch], values[stretch], color=cs_branch, linestyle='-' if stable[start] else '--')
+                start = k
+
+        for kind, value, description in branch['events']:
+            if kind != 'stability':
+                ax.axvline(value, color=event_colours[kind], linestyle=':', linewidth=1)
+
+        ax.set_ylabel("%s (%s)" %(name, units))
+
+    axes[-1].set_xlabel(parameter)
+    fig.tight_layout(rect=[0, 0.03, 1, 0.95])
+
+    return fig
+
+
+# Colours of the branch and of the lines marking events in the diagram
+cs_branch = 'darkblue'
+event_colours = {'fold': 'red', 'regime': 'limegreen'}
+
+
+if __name__ == "__main__":
+
+    print "Following the equilibria from %s = %g to %g..." %(parameter, parameter_range[0], parameter_range[1])
+    start = time.time()
+    branch = continuation()
+    print "%d equilibria in %.1f s, stopped as it %s" %(len(branch['parameter']), time.time() - start, branch['stopped'])
+
+    lines = ["%-10s %14s  %s" %(kind, "%.6g" %value, description) for kind, value, description in branch['events']]
+    if not lines:
+        lines = ["No folds, changes of regime or of stability"]
+    print "\n".join(lines)
+
+    model.make_save_loc()
+
+    f = open(save_loc + "continuation.txt", 'w')
+    f.write( "\n".join(lines + [""] + table(branch)) + "\n" )
+    f.close()
+
+    diagram(branch).savefig(save_loc + "continuation.pdf", format='pdf')
+
+    print "\nSaved to %scontinuation.txt, %scontinuation.pdf" %(save_loc, save_loc)
@@ -0,0 +1,187 @@
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+
+from constants import *
+from params import *
+import calculations as calc
+import nbox
+
+# Accuracy against cost of the timestep and time integrator: runs the model
+# configured in params.py (for nyr_test years) with each timestep in dts and
+# each integrator, and measures the error in the box temperatures and heat
+# transports against a run with a much smaller timestep. The random noise
+# in the evaporation is switched off, so that the differences between runs
+# are only due to the time integration.
+#
+# Run with
+#     python convergence.py
+# The table is printed and saved, with a plot of error against run time,
+# to save_loc/convergence.txt and save_loc/convergence.pdf.
+#
+# The explicit runs use the same model as main.py: model.py for n_boxes = 2,
+# and nbox.py otherwise. The semi-implicit runs use nbox.py.
+
+# ----------------- #
+#  Runs to compare  #
+# ----------------- #
+# Length of each run (years)
+nyr_test = 50
+
+# Timesteps to try (days), and of the reference run. Each must divide
+# compare_every, the interval at which the runs are compared.
+dts = [0.25, 0.5, 1., 2., 3., 5.]
+dt_ref = 1./16
+compare_every = MONTH
+
+# Time integrators: whether the atmospheric heat transport is stepped
+# forward implicitly (nbox.implicit_atm). 'explicit' is forward Euler,
+# as in model.py (which is what's run and timed for two boxes). The
+# reference run uses the semi-implicit integrator, which is stable for any
+# number of boxes.
+INTEGRATORS = {'explicit': False, 'semi-implicit': True}
+
+# Largest acceptable RMS error in the temperatures (K)
+tolerance = 0.01
+
+# Variables compared, and the factors converting them to the units reported
+# (K for temperatures, PW for heat transports)
+VARIABLES = (('Ta', 1.), ('Ts', 1.), ('To', 1.), ('Fa', nbox.AREA/PW), ('Fo', nbox.AREA/PW))
+
+
+def run(dt_days, implicit):
+    """ Runs the model for nyr_test years with a timestep of dt_days, and
+        returns (boxes, glob, wall time in seconds). The explicit runs use
+        the model main.py runs (nbox.selected()), so for n_boxes = 2 they're
+        timed with model.py. """
+
+    if implicit:
+        model = nbox
+    else:
+        model = nbox.selected()
+
+    settings = {'dt': float(dt_days*DAY), 'nt': int(round( nyr_test*YEAR / (dt_days*DAY) ))}
+
+    # Set the timestep and integrator, and switch off the noise, restoring
+    # them afterwards
+    with calc.overridden(model, **settings), calc.overridden(nbox, implicit_atm=implicit), \
+            calc.overridden(FEVA_NOISE=0.):
+        np.random.seed(0)
+        data = model.initialise()
+
+        start = time.time()
+        with np.errstate(all='ignore'):
+            for n in range(model.nt):
+                model.update(n, *data)
+                model.step(n, *data)
+            model.update(model.nt, *data)
+        wall = time.time() - start
+
+    if len(data) == 3:
+        # (box1, box2, glob) from model.py, as (timestep, box) arrays like nbox.py's
+        box1, box2, glob = data
+        boxes = dict( (var, np.column_stack((box1[var], box2[var]))) for var in nbox.BOX_VARS )
+        glob = dict( (var, glob[var][:,None]) for var in nbox.EDGE_VARS )
+        data = (boxes, glob)
+
+    return data + (wall,)
+
+
+def compared(data, dt_days):
+    """ The variables of a run at the comparison times, as a dictionary of
+        (time, box) arrays in the units reported """
+
+    every = compare_every / (dt_days*DAY)
+    if abs(every - round(every)) > 1e-9:
+        raise ValueError("Timestep of %g days doesn't divide compare_every" %dt_days)
+    rows = slice(None, None, int(round(every)))
+
+    boxes, glob = data[:2]
+    values = {}
+    for var, factor in VARIABLES:
+        series = boxes[var] if var in boxes else glob[var]
+        values[var] = series[rows] * factor
+
+    return values
+
+
+def errors(values, reference):
+    """ RMS error of each variable, over all comparison times and boxes """
+    return dict( (var, np.sqrt(np.mean( (values[var] - reference[var])**2 ))) for var, factor in VARIABLES )
+
+
+def temperature_error(err):
+    """ Largest of the errors in the temperatures """
+    return max(err['Ta'], err['Ts'], err['To'])
+
+
+if __name__ == "__main__":
+
+    print "Reference run (semi-implicit, dt = %g days)..." %dt_ref
+    reference_data = run(dt_ref, True)
+    reference = compared(reference_data, dt_ref)
+    print "  %.1f s" %reference_data[2]
+
+    # (integrator, dt, wall time, errors) of each run
+    results = []
+    for name in sorted(INTEGRATORS):
+        for dt_days in dts:
+            print "%s, dt = %g days..." %(name, dt_days)
+            data = run(dt_days, INTEGRATORS[name])
+            results.append( (name, dt_days, data[2], errors(compared(data, dt_days), reference)) )
+
+    # ------- #
+    #  Table  #
+    # ------- #
+    variables = [var for var, factor in VARIABLES]
+    header = "%-14s %8s %9s " %("integrator", "dt (d)", "time (s)") \
+                + " ".join("%10s" %("%s (%s)" %(var, "K" if var.startswith('T') else "PW")) for var in variables)
+    lines = [header]
+    for name, dt_days, wall, err in results:
+        lines.append( "%-14s %8g %9.2f " %(name, dt_days, wall) + " ".join("%10.3g" %err[var] for var in variables) )
+
+    # The quickest run with the temperatures within the tolerance
+    # (comparisons with nan are False, so unstable runs are excluded)
+    ok = [result for result in results if temperature_error(result[3]) <= tolerance]
+    if ok:
+        name, dt_days, wall, err = min(ok, key=lambda result: result[2])
+        lines.append( "\nQuickest within %g K: %s, dt = %g days (%.2f s)" %(tolerance, name, dt_days, wall) )
+    else:
+        lines.append( "\nNo run is within %g K" %tolerance )
+
+    print "\nRMS errors over %d years, against dt = %g days:" %(nyr_test, dt_ref)
+    print "\n".join(lines)
+
+    nbox.make_save_loc()
+
+    f = open(save_loc + "convergence.txt", 'w')
+    f.write( "\n".join(lines) + "\n" )
+    f.close()
+
+    # ------ #
+    #  Plot  #
+    # ------ #
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for name in sorted(INTEGRATORS):
+        runs = [result for result in results if result[0] == name]
+        walls = [result[2] for result in runs]
+        for ax, err in zip(axes, ([temperature_error(result[3]) for result in runs],
+                                  [max(result[3]['Fa'], result[3]['Fo']) for result in runs])):
+            line, = ax.loglog(walls, err, 'o-', label=name)
+            for wall, value, result in zip(walls, err, runs):
+                ax.annotate("%g d" %result[1], (wall, value), color=line.get_color(), fontsize=8,
+                            xytext=(4, 4), textcoords='offset points')
+
+    axes[0].axhline(tolerance, color='k', linestyle='--', label="tolerance")
+    axes[0].set_ylabel("RMS error in temperatures (K)")
+    axes[0].set_title("Temperatures")
+    axes[1].set_ylabel("RMS error in heat transports (PW)")
+    axes[1].set_title("Heat transports")
+    for ax in axes:
+        ax.set_xlabel("Run time (s)")
+        ax.legend(loc='best')
+    fig.suptitle("Error against cost, %d years with %d boxes" %(nyr_test, n_boxes))
+
+    fig.savefig(save_loc + "convergence.pdf", format='pdf')
+
+    print "\nSaved to %sconvergence.txt, %sconvergence.pdf" %(save_loc, save_loc)
@@ -0,0 +1,242 @@
+import os
+import time
+import numpy as np
+from sys import argv
+
+from constants import *
+from params import *
+import calculations as calc
+import plot
+import nbox
+
+# The two-box model described in the documentation, or the N-box version
+model = nbox.selected()
+
+# Linear-response emulator: predicts the simulation of any CO2 pathway in a
+# fraction of a second, from a control simulation and a few simulations in
+# which CO2 jumps to a higher concentration at the start ("step" runs).
+#
+# CO2 only enters the model through the emissivity of the atmosphere (see
+# calc.EPSA), which changes by a factor of 1 - exp(-ALPHA * (CO2 - CO2_init))
+# (the "forcing", see forcing()). Each step run gives the response of every
+# variable to a unit step in forcing, and the response to any pathway is the
+# sum of the responses to its changes in forcing at each time: the
+# convolution of the response with the changes in forcing, done with FFTs.
+# The step runs are done with a few different jumps in CO2, and the spread
+# between their responses gives an estimate of the error of the prediction.
+#
+# The emulator uses the same timestep, length and initial conditions as the
+# simulations in params.py, and the runs are done without the random noise
+# in the evaporation, so it predicts the noise-free simulation. It's saved
+# to emulator_file in save_loc, and fitted again if any of the settings it
+# depends on have changed (see fingerprint()).
+#
+#     python emulator.py              predict the CO2 pathway in params.py
+#     python emulator.py validate     ... and compare with a full simulation
+#     python emulator.py save         ... and save its figures (two boxes)
+#     python emulator.py fit          fit the emulator even if it's up to date
+
+# ---------- #
+#  Settings  #
+# ---------- #
+# File the fitted emulator is saved to, with the output of the simulations
+emulator_file = save_loc + "emulator.npz"
+
+# CO2 concentrations of the step runs, as multiples of CO2_init
+STEP_FACTORS = (1.5, 2., 3.)
+
+# Time between the predicted values (rounded to a multiple of dt)
+resolution = MONTH
+
+# Parameters which don't change what the emulator predicts: those for the
+# CO2 pathway, which is given to predict(), and for saving
+IGNORED = ('CO2_final', 'CO2_increase', 'tau_CO2', 'save_loc', 'save_format', 'n_print', 'n_save')
+
+
+def forcing(co2):
+    """ Change in the CO2 part of the emissivity of the atmosphere, relative to
+        CO2_init (up to a factor, which is the same for every box) """
+    return 1 - np.exp(-ALPHA * (co2 - CO2_init))
+
+
+def co2_pathway():
+    """ CO2 concentration (ppm) at each timestep, as specified in params.py """
+    return model.initialise()[-1]['CO2'].copy()
+
+
+def fingerprint():
+    """ The constants and parameters used by the model (those of
+        calculations.py, which has them all, including any that have been
+        changed since it was imported) as a string, so that an emulator
+        fitted with different ones can be recognised. """
+
+    names = [name for name in dir(calc) if not name.startswith('_') and name not in IGNORED
+                and isinstance(getattr(calc, name), (bool, int, float, str))]
+    return repr( [(name, getattr(calc, name)) for name in sorted(names)] )
+
+
+def run(co2):
+    """ Run the model, without noise in the evaporation, with the CO2
+        concentration 'co2' (ppm) at each timestep. Returns the
+        (timestep, variable) state array (see model.initialise). """
+
+    with calc.overridden(FEVA_NOISE=0.):
+        np.random.seed(0)
+        data = model.initialise()
+        data[-1]['CO2'][:] = co2
+
+        for n in range(nt):
+            model.update(n, *data)
+            model.step(n, *data)
+        model.update(nt, *data)
+
+    return data[0]['Ta'].base
+
+
+class Emulator(object):
+    """ Predicts simulations from a control run and the responses to steps in
+        forcing, all sampled every 'every' timesteps.
+
+        control     - (time, variable) state array of the control run
+        responses   - (step run, time, variable) response of each step run
+                      per unit forcing
+        """
+
+    def __init__(self, control, responses, every, fingerprint):
+        self.control = control
+        self.responses = responses
+        self.every = every
+        self.fingerprint = fingerprint
+
+        # Transform of the responses, zero padded so that the product of
+        # transforms gives their convolution with the forcing, not a circular one
+        self.nfft = 2**int(np.ceil(np.log2( 2*len(control) )))
+        self.responses_fft = np.fft.rfft(responses, self.nfft, axis=1)
+
+    def predict(self, co2):
+        """ Predict the simulation with the CO2 concentration 'co2' (ppm) at
+            each timestep (as glob['CO2']). Returns the predicted state array
+            and an estimate of its error, both (time, variable) arrays sampled
+            every self.every timesteps. """
+
+        co2 = np.asarray(co2, dtype=float)[::self.every]
+        if len(co2) != len(self.control):
+            raise ValueError("Expected a CO2 concentration at each of %d timesteps" %((len(self.control)-1)*self.every + 1))
+
+        # Change in forcing at each time (from CO2_init before the start)
+        f = forcing(co2)
+        df = np.concatenate( ([f[0]], np.diff(f)) )
+
+        # Response predicted by each step run
+        df_fft = np.fft.rfft(df, self.nfft)
+        predictions = np.fft.irfft(self.responses_fft * df_fft[None,:,None], self.nfft, axis=1)[:,:len(co2)]
+
+        response = predictions.mean(axis=0)
+        error = np.abs(predictions - response).max(axis=0)
+
+        state = self.control + response
+        state[:,-1] = co2       # CO2 is the last column (and time is the same as the control)
+
+        return state, error
+
+    def save(self, path=emulator_file):
+        model.make_save_loc()
+        np.savez(path, control=self.control, responses=self.responses, every=self.every,
+                 fingerprint=self.fingerprint)
+
+
+def fit(step_factors=STEP_FACTORS):
+    """ Fit the emulator: one control run and one step run for each of step_factors """
+
+    every = max(1, int(round( resolution / dt )))
+
+    print "Control run..."
+    control = run(np.full(nt+1, CO2_init))[::every].copy()
+
+    responses = []
+    for factor in step_factors:
+        print "Step run, CO2 = %g ppm..." %(factor*CO2_init)
+        state = run(np.full(nt+1, factor*CO2_init))[::every]
+        responses.append( (state - control) / forcing(factor*CO2_init) )
+
+    return Emulator(control, np.array(responses), every, fingerprint())
+
+
+def load(path=emulator_file):
+    """ Load the emulator saved to 'path', fitting (and saving) it again if
+        it's missing or was fitted with different constants or parameters """
+
+    if os.path.exists(path):
+        saved = np.load(path)
+        if str(saved['fingerprint']) == fingerprint():
+            return Emulator(saved['control'], saved['responses'], int(saved['every']), str(saved['fingerprint']))
+        print "Constants or parameters have changed since the emulator was fitted"
+
+    emulator = fit()
+    emulator.save(path)
+
+    return emulator
+
+
+def as_data(state):
+    """ Dictionaries of the columns of a predicted state array, as returned
+        by model.initialise() """
+    if n_boxes == 2:
+        return plot.as_data(*np.hsplit(state, 3))
+    else:
+        boxes, glob = model.as_data(state)
+        boxes['Te'] = model.emission_temperatures(n_boxes)
+        return boxes, glob
+
+
+def _forced(name):
+    """ Whether the column 'name' is time or CO2, which are given rather than predicted """
+    return name.split('.')[-1] in ('time', 'CO2')
+
+
+def validate(emulator, co2):
+    """ Compare the prediction of the simulation with the CO2 concentration
+        'co2' against the simulation itself. Returns a dictionary with the
+        (RMS error, largest error, largest estimated error) of each variable. """
+
+    state, error = emulator.predict(co2)
+    full = run(co2)[::emulator.every]
+
+    return dict( (name, (np.sqrt(np.mean( (state[:,i] - full[:,i])**2 )), np.abs(state[:,i] - full[:,i]).max(),
+                         error[:,i].max()))
+                 for i, name in enumerate(nbox.state_columns()) if not _forced(name) )
+
+
+if __name__ == "__main__":
+
+    if 'fit' in argv:
+        emulator = fit()
+        emulator.save()
+    else:
+        emulator = load()
+
+    co2 = co2_pathway()
+
+    start = time.time()
+    state, error = emulator.predict(co2)
+    print "Predicted %d years in %.1f ms" %(nyr, 1000*(time.time() - start))
+
+    # Change in the main variables over the simulation, with estimated errors
+    names = nbox.state_columns()
+    print "\n%-10s %12s %12s" %("variable", "change", "est. error")
+    for i, name in enumerate(names):
+        if not _forced(name):
+            print "%-10s %12.4g %12.3g" %(name, state[-1,i] - state[0,i], error[:,i].max())
+
+    if 'validate' in argv:
+        print "\nRunning the full simulation..."
+        errors = validate(emulator, co2)
+        print "%-10s %12s %12s %12s" %("variable", "RMS error", "max error", "est. error")
+        for name in names:
+            if name in errors:
+                print "%-10s %12.3g %12.3g %12.3g" %((name,) + errors[name])
+
+    if 'save' in argv and n_boxes == 2:
+        model.make_save_loc()
+        plot.save_figs(plot.all_figs(*as_data(state)), save_loc, "emulated.pdf")
+        print "\nSaved %semulated.pdf" %save_loc
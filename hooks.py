@@ -0,0 +1,196 @@
+import numpy as np
+
+# Hooks: functions called by main.py during the integration, for things like
+# stopping a simulation once Ts2 drops below a threshold, recording when
+# convection first happens, or changing the CO2 concentration part way
+# through, without changing main.py.
+#
+# Hooks are registered with every(), each_step(), when() or at_end(), before
+# the simulation starts: from the module named by hooks_module in params.py,
+# or before running main.py from another script. For example
+#
+#     import hooks
+#
+#     # Stop once the extra-tropics have cooled below 275 K
+#     hooks.when(lambda box1, box2, glob: box2['Ts'] < 275., hooks.stop, every=30)
+#
+#     # Print the heat transport every year
+#     def report(n, box1, box2, glob):
+#         print "Fa = %g W m-2" %glob['Fa'][n]
+#     hooks.every(int(YEAR/dt), report)
+#
+# Hooks are called after update(n) at the steps they're due, with n and the
+# data as returned by model.initialise(): box1, box2, glob for the two-box
+# model or boxes, glob for the N-box model. Rows up to and including n have
+# been calculated. The data is read-only, except for glob['CO2'], which can
+# be changed for the steps to come. A hook can stop the simulation by
+# returning STOP: the simulation ends at the step the hook was called for
+# (for when(), the first step the condition held), and any rows calculated
+# after it aren't saved or plotted. Functions registered with at_end() are
+# called in the same way once the simulation has finished (or been
+# stopped), with n the last step kept.
+#
+# main.py compares the step with the next step a hook is due, so hooks cost
+# nothing when there aren't any, and nothing in between the steps they're due.
+
+# Returned by a hook to stop the simulation
+STOP = "stop"
+
+# Registered hooks
+_registry = []
+
+# Functions called at the end of the simulation
+_at_end = []
+
+# Read-only views of the simulation data, made by start()
+_data = None
+
+
+class _Hook(object):
+    """ A registered hook, due every 'every' steps. If it has a condition,
+        'callback' is only called when it's true. """
+
+    def __init__(self, callback, every, condition=None, once=False):
+        if every < 1:
+            raise ValueError("Hooks must be called every 1 or more steps")
+
+        self.callback = callback
+        self.every = int(every)
+        self.condition = condition
+        self.once = once
+        self.next = 0       # next step the hook is due
+        self.checked = 0    # first row the condition hasn't been checked for
+
+
+def every(k, callback):
+    """ Call callback(n, *data) every k steps, starting with step 0. Returns callback. """
+    _registry.append( _Hook(callback, k) )
+    return callback
+
+
+def each_step(callback):
+    """ Call callback(n, *data) at every step. Returns callback. """
+    return every(1, callback)
+
+
+def when(condition, callback, every=1, once=True):
+    """ Call callback(n, *data) when condition(*data) is true at step n.
+
+        The condition is checked every 'every' steps, for all of the steps
+        since it was last checked at once: it's given the rows of the data
+        for those steps, and returns a bool, or an array which is true for
+        each step (row) the condition holds (e.g. box2['Ts'] < 275.). n is
+        the first of those steps. For the N-box model the condition holds at
+        a step if it holds for any box.
+
+        If 'once', the hook is removed after the first time it's called. """
+
+    _registry.append( _Hook(callback, every, condition, once) )
+    return callback
+
+
+def at_end(callback):
+    """ Call callback(n, *data) once the simulation has finished. Returns callback. """
+    _at_end.append(callback)
+    return callback
+
+
+def stop(n, *data):
+    """ A callback which stops the simulation """
+    return STOP
+
+
+def clear():
+    """ Remove all registered hooks """
+    del _registry[:]
+    del _at_end[:]
+
+
+def rows(data, first, last):
+    """ The data (as returned by model.initialise()) for rows first, ..., last-1 """
+
+    nrows = len(data[-1]['time'])
+    return tuple( dict( (key, value[first:last] if _is_series(value, nrows) else value)
+                        for key, value in d.items() )
+                  for d in data )
+
+
+def _is_series(value, nrows):
+    """ Whether 'value' is a variable with one row per timestep """
+    return isinstance(value, np.ndarray) and value.ndim > 0 and len(value) == nrows
+
+
+def start(data):
+    """ Called by main.py before the integration, with the data returned by
+        model.initialise(). Returns the first step a hook is due at, or None. """
+
+    global _data
+
+    if not _registry and not _at_end:
+        return None
+
+    # Read-only views, apart from CO2
+    _data = []
+    for d in data:
+        views = {}
+        for key, value in d.items():
+            if isinstance(value, np.ndarray) and key != 'CO2':
+                value = value.view()
+                value.flags.writeable = False
+            views[key] = value
+        _data.append(views)
+    _data = tuple(_data)
+
+    for hook in _registry:
+        hook.next = 0
+        hook.checked = 0
+
+    return 0 if _registry else None
+
+
+def run(n):
+    """ Called by main.py after update(n) when a hook is due. Returns the next
+        step a hook is due at (None if there are none), and the step the
+        simulation stops at if a hook has stopped it (otherwise None): the
+        step the hook was called for, which for when() is the first step
+        the condition held, and can be before n. """
+
+    stopped = None
+
+    for hook in list(_registry):
+        if hook.next != n:
+            continue
+        hook.next += hook.every
+
+        if hook.condition is None:
+            if hook.callback(n, *_data) is STOP:
+                stopped = n if stopped is None else min(stopped, n)
+            continue
+
+        # Check the condition for every step since it was last checked
+        held = np.asarray( hook.condition(*rows(_data, hook.checked, n+1)) )
+        if held.ndim == 0:
+            first = n if held else None
+        else:
+            held = held.reshape(len(held), -1).any(axis=1)
+            first = hook.checked + int(np.argmax(held)) if held.any() else None
+        hook.checked = n+1
+
+        if first is not None:
+            if hook.callback(first, *_data) is STOP:
+                stopped = first if stopped is None else min(stopped, first)
+            if hook.once:
+                _registry.remove(hook)
+
+    if not _registry:
+        return None, stopped
+    return min(hook.next for hook in _registry), stopped
+
+
+def end(n):
+    """ Called by main.py after the integration, with the last step kept """
+
+    for callback in _at_end:
+        callback(n, *_data)
+
+    return
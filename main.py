@@ -2,13 +2,27 @@ import numpy as np
 
 from constants import *
 from params import *
-import model
 import plot
+from writer import BackgroundWriter
+import hooks
+import nbox
+
+# The two-box model described in the documentation, or the N-box version
+model = nbox.selected()
 
 # ------------------ #
 #  Initialise model  #
 # ------------------ #
-box1, box2, glob = model.initialise()
+# (box1, box2, glob) for the two-box model, (boxes, glob) for the N-box model
+data = model.initialise()
+
+# Periodic saves are written in the background while the integration continues
+writer = BackgroundWriter()
+
+# Functions to be called during the integration (see hooks.py)
+if hooks_module is not None:
+    __import__(hooks_module)
+next_hook = hooks.start(data)
 
 
 # --------------------------- #
@@ -17,10 +31,18 @@ box1, box2, glob = model.initialise()
 for n in range(nt):
     
     # Update fluxes, moisture, circulation using current temperatures
-    model.update(n, box1, box2, glob)
+    model.update(n, *data)
+
+    # Call the hooks due at this step
+    if n == next_hook:
+        next_hook, stop = hooks.run(n)
+        if stop is not None:
+            n = stop
+            print "Stopped by a hook at step %d" %n
+            break
 
     # Step temperatures forward
-    model.step(n, box1, box2, glob)
+    model.step(n, *data)
 
     # Print every 'n_print' steps
     if n % n_print == 0:
@@ -32,13 +54,21 @@ for n in range(nt):
         years, months, days = model.simulation_time(n)
         "Saving time series at simulation time: %d years, %d months, %d days" %(years, months, days)
         
-        model.save(n+1, box1, box2, glob)
+        model.save(n+1, *data, writer=writer)
 
-# Update fluxes, moisture, circulation for final timestep
-model.update(nt, box1, box2, glob)
+else:
+    # Update fluxes, moisture, circulation for final timestep
+    n = nt
+    model.update(nt, *data)
+
+# Number of rows saved: nt, or up to the step a hook stopped the simulation at
+n_end = nt if n == nt else n+1
+
+# Call the hooks for the end of the simulation, with the last row saved
+hooks.end(n_end-1)
 
 # Print final time
-years, months, days = model.simulation_time(nt)
+years, months, days = model.simulation_time(n)
 print "Final simulation time: %d years, %d months, %d days" %(years, months, days)
 
 
@@ -47,15 +77,21 @@ print "Final simulation time: %d years, %d months, %d days" %(years, months, day
 # -------------- #
 print "\nSave directory: %s" %save_loc
 print "Saving time series data..."
-model.save(nt, box1, box2, glob)
+model.save(n_end, *data, writer=writer)
 
 
 # -------------- #
 #  Save figures  #
 # -------------- #
-print "Saving figures..."
-plot.auto(box1, box2, glob)
+# The figures are for the two-box model
+if n_boxes == 2:
+    print "Saving figures..."
+    plot.auto(*hooks.rows(data, 0, n_end))
+
 
+# Wait for the data to be written
+writer.close()
+print "Time series data saved (%d files written)" %writer.nwritten
 
 print "Finished"
 
@@ -1,9 +1,12 @@
 import os
+import json
+import zipfile
 import numpy as np
 
 from constants import *
 from params import *
 import calculations as calc
+from writer import write_array
 
 
 def simulation_time(n):
@@ -14,48 +17,91 @@ def simulation_time(n):
     
     return years, months, days
 
+# Variables of each box and the global variables, in the order of the
+# columns of the state array and of the saved files
+BOX_VARS = ('Ta', 'Ts', 'To', 'Ft', 'Fs', 'Feva', 'MSE')
+GLOB_VARS = ('time', 'Fa', 'Fo', 'Psia', 'Psio', 'MTspt', 'CO2')
+
+
+def columns():
+    """ Names of the columns of the state array, e.g. 'box1.Ta', 'glob.CO2' """
+    return ['box1.'+var for var in BOX_VARS] + ['box2.'+var for var in BOX_VARS] \
+                + ['glob.'+var for var in GLOB_VARS]
+
+
+def CO2_trajectory(nt, dt):
+    """ CO2 concentration at each of the nt+1 timesteps of length dt, following
+        the trajectory given by CO2_increase in params.py. """
+
+    if CO2_increase == 'linear':
+        return np.linspace(CO2_init, CO2_final, nt+1)
+    elif CO2_increase == 'exp':
+        return CO2_final - (CO2_final-CO2_init) * np.exp(-np.arange(nt+1)*dt / tau_CO2)
+    else:
+        return np.full(nt+1, CO2_init, dtype=float)
+
+
+def make_save_loc():
+    """ Create the directory save_loc if it doesn't exist. """
+
+    if save_loc not in ("", None):
+        if not os.path.exists(save_loc):
+            os.makedirs(save_loc)
+
+
 def initialise():
     """ Initialise the model using conditions specified in params.py. """
 
-    # Create dictionaries to hold simulation data
-    # Initialise with empty arrays of size = number of timesteps + 1 (for initial conditions)
-
-    box1 = {'Ta': np.zeros(nt+1),         # Atmospheric temperature
-            'Ts': np.zeros(nt+1),         # Surface temperature
-            'To': np.zeros(nt+1),         # Oceanic temperature
-            'Ft': np.zeros(nt+1),         # Top of atmosphere flux
-            'Fs': np.zeros(nt+1),         # Surface flux
-            'Feva': np.zeros(nt+1),       # Evaporation
-            'MSE': np.zeros(nt+1),        # Moist static energy
+    # The whole simulation is held in one contiguous array of size
+    # (number of timesteps + 1 (for initial conditions), number of variables).
+    # Each row holds one timestep, with the box 1, box 2 and global variables
+    # side by side in the same order as the columns of the saved files.
+    state = np.zeros( (nt+1, 21) )
+
+    # Create dictionaries of views of the columns of 'state'
+
+    box1 = {'Ta': state[:,0],             # Atmospheric temperature
+            'Ts': state[:,1],             # Surface temperature
+            'To': state[:,2],             # Oceanic temperature
+            'Ft': state[:,3],             # Top of atmosphere flux
+            'Fs': state[:,4],             # Surface flux
+            'Feva': state[:,5],           # Evaporation
+            'MSE': state[:,6],            # Moist static energy
             'Te': Te1                     # Emission temperature (from params)
             }
     
-    box2 = {'Ta': np.zeros(nt+1),         # Atmospheric temperature
-            'Ts': np.zeros(nt+1),         # Surface temperature
-            'To': np.zeros(nt+1),         # Oceanic temperature
-            'Ft': np.zeros(nt+1),         # Top of atmosphere flux
-            'Fs': np.zeros(nt+1),         # Surface flux
-            'Feva': np.zeros(nt+1),       # Evaporation
-            'MSE': np.zeros(nt+1),        # Moist static energy
+    box2 = {'Ta': state[:,7],             # Atmospheric temperature
+            'Ts': state[:,8],             # Surface temperature
+            'To': state[:,9],             # Oceanic temperature
+            'Ft': state[:,10],            # Top of atmosphere flux
+            'Fs': state[:,11],            # Surface flux
+            'Feva': state[:,12],          # Evaporation
+            'MSE': state[:,13],           # Moist static energy
             'Te': Te2                     # Emission temperature (from params)
             }
 
-    glob = {'time': np.arange(nt+1)*dt,   # simulation time in seconds
-            'Fa' : np.zeros(nt+1),        # Atmospheric flux
-            'Fo' : np.zeros(nt+1),        # Oceanic flux
-            'Psia': np.zeros(nt+1),       # Atmospheric circulation strength
-            'Psio': np.zeros(nt+1),       # Oceanic circulation strength
-            'MTspt': np.zeros(nt+1),      # Moisture transport
+    glob = {'time': state[:,14],          # simulation time in seconds
+            'Fa' : state[:,15],           # Atmospheric flux
+            'Fo' : state[:,16],           # Oceanic flux
+            'Psia': state[:,17],          # Atmospheric circulation strength
+            'Psio': state[:,18],          # Oceanic circulation strength
+            'MTspt': state[:,19],         # Moisture transport
+            'CO2': state[:,20],           # Carbon dioxide
             }
 
+    glob['time'][:] = np.arange(nt+1)*dt
+
     # Carbon dioxide trajectory given in params
-    if CO2_increase == 'linear':
-        glob['CO2'] = np.linspace(CO2_init, CO2_final, nt+1)
-    elif CO2_increase == 'exp':
-        glob['CO2'] = CO2_final - (CO2_final-CO2_init) * np.exp(-np.arange(nt+1)*dt / tau_CO2)
-    else:
-        glob['CO2'] = np.ones(nt+1) * CO2_init
+    glob['CO2'][:] = CO2_trajectory(nt, dt)
        
+    # Seed for the random numbers, which the 'prognostic' save format needs
+    # in order to replay them when the data is loaded
+    glob['seed'] = seed
+    if glob['seed'] is None and save_format == 'prognostic':
+        glob['seed'] = np.random.randint(2**31 - 1)
+    if glob['seed'] is not None:
+        np.random.seed(glob['seed'])
+
     # Initial conditions specified in params.py,
     # multiplied by a random noise of magnitude 'ic'.
     box1['Ta'][0] = Ta1_init + ic*np.random.normal()
@@ -143,62 +189,214 @@ def step(n, box1, box2, glob):
 
     return
 
-def save(n, box1, box2, glob):
-    """ Save time series data for plotting. """
+def settable():
+    """ Constants which can be changed by setting them in calculations.py
+        (see calc.settable) """
+    return calc.settable(initialise, update, step)
+
+def state_array(box1):
+    """ Returns the (timestep, variable) array which the dictionaries
+        created by initialise() are views of. """
+    return box1['Ta'].base
+
+
+def save(n, box1, box2, glob, writer=None):
+    """ Save time series data for plotting.
+        If a writer.BackgroundWriter is given the files are written in the
+        background, otherwise they have been written when save returns. """
   
     # Create the directory if it doesn't exist
-    if save_loc not in ("", None):
-        if not os.path.exists(save_loc):
-            os.makedirs(save_loc)
+    make_save_loc()
 
-    # ------- #
-    #  Box 1  #
-    # ------- #
     # (row,col) = (timestep,variable)
-    box1_arr = np.zeros( (n, 7) )
-
-    box1_arr[:,0] = box1['Ta'][:n]
-    box1_arr[:,1] = box1['Ts'][:n]
-    box1_arr[:,2] = box1['To'][:n]
-    box1_arr[:,3] = box1['Ft'][:n]
-    box1_arr[:,4] = box1['Fs'][:n]
-    box1_arr[:,5] = box1['Feva'][:n]
-    box1_arr[:,6] = box1['MSE'][:n]
-    
-    box1_save_file = save_loc + "box1.out"
-    np.savetxt(box1_save_file, box1_arr)
-    
-    # ------- #
-    #  Box 2  #
-    # ------- #
-    box2_arr = np.zeros( (n, 7) )
-
-    box2_arr[:,0] = box2['Ta'][:n]
-    box2_arr[:,1] = box2['Ts'][:n]
-    box2_arr[:,2] = box2['To'][:n]
-    box2_arr[:,3] = box2['Ft'][:n]
-    box2_arr[:,4] = box2['Fs'][:n]
-    box2_arr[:,5] = box2['Feva'][:n]
-    box2_arr[:,6] = box2['MSE'][:n]
-    
-    box2_save_file = save_loc + "box2.out"
-    np.savetxt(box2_save_file, box2_arr)
-
-    # ------------- #
-    #  Global data  #
-    # ------------- #
-    glob_arr = np.zeros( (n, 7) )
-
-    glob_arr[:,0] = glob['time'][:n]
-    glob_arr[:,1] = glob['Fa'][:n]
-    glob_arr[:,2] = glob['Fo'][:n]
-    glob_arr[:,3] = glob['Psia'][:n]
-    glob_arr[:,4] = glob['Psio'][:n]
-    glob_arr[:,5] = glob['MTspt'][:n]
-    glob_arr[:,6] = glob['CO2'][:n]
-    
-    glob_save_file = save_loc + "global.out"
-    np.savetxt(glob_save_file, glob_arr)
+    # The first n rows are a contiguous block, so nothing needs to be copied.
+    # They're also complete (rows are only written by update(n) and step(n-1)),
+    # so they can be saved in the background while the simulation continues.
+    state = state_array(box1)[:n]
+
+    if writer is None:
+        write = write_array
+    else:
+        write = writer.write
+
+    if save_format == 'npy':
+        write(save_loc + "state.npy", state)
+
+    elif save_format == 'prognostic':
+        # Just what's needed to calculate everything else (see load_prognostic)
+        # (in C order, one row after another, so it can be read a block of rows
+        # at a time: see prognostic_chunks)
+        write(save_loc + "prognostic.npz", {'prognostic': np.ascontiguousarray(state[:,PROGNOSTIC_COLS]),
+                                            'dt': dt,
+                                            'seed': glob['seed'],
+                                            'Te': [box1['Te'], box2['Te']],
+                                            'constants': json.dumps(model_constants())})
+
+    else:
+        write(save_loc + "box1.out", state[:,0:7])
+        write(save_loc + "box2.out", state[:,7:14])
+        write(save_loc + "global.out", state[:,14:21])
     
     return
 
+
+# Columns of the state array saved with save_format = 'prognostic': the
+# temperatures of each box (Ta, Ts, To), and CO2
+PROGNOSTIC_COLS = [0, 1, 2, 7, 8, 9, 20]
+
+# Number of rows of them read at a time when they're only needed to replay
+# the random numbers
+PROGNOSTIC_BLOCK = 2**16
+
+def model_constants():
+    """ Values of the constants used by calculations.py, and of WaVa_feedback """
+
+    constants = dict( (name, getattr(calc, name)) for name in dir(calc)
+                        if name.isupper() and isinstance(getattr(calc, name), (int, float)) )
+    constants['WaVa_feedback'] = WaVa_feedback
+
+    return constants
+
+
+def load_prognostic(path, first=0, last=None):
+    """ Returns rows first, ..., last-1 of the (timestep, variable) state array
+        from a file saved with save_format = 'prognostic'.
+
+        The other variables are calculated from the temperatures and CO2 as in
+        update(), but for all of the timesteps at once, using the constants the
+        simulation was run with. The random numbers for the noise in the
+        evaporation are drawn again from the saved seed, in the same order:
+        one for each box that was convecting, at each timestep. """
+
+    chunks = list( prognostic_chunks(path, None, first, last) )
+    if not chunks:
+        return np.zeros( (0, 21) )
+
+    return chunks[0]
+
+
+def prognostic_chunks(path, rows, first=0, last=None):
+    """ As load_prognostic, but yields the state array 'rows' rows at a time
+        (all at once if None), so that a long simulation can be gone through
+        without calculating all of it at once. The saved temperatures and CO2
+        are read from the file as they're needed too, a block of rows at a
+        time, and the random numbers are only drawn once. """
+
+    nsaved, read = _saved_rows(path, 'prognostic')
+    if last is None or last > nsaved:
+        last = nsaved
+    first = min(first, last)
+    if rows is None:
+        rows = max(1, last-first)
+
+    saved = np.load(path)
+    dt_saved = float(saved['dt'])
+    Te1, Te2 = saved['Te']
+    constants = json.loads(str(saved['constants']))
+    WaVa = constants.pop('WaVa_feedback')
+
+    def convecting(prognostic):
+        return prognostic[:,[1,4]] - prognostic[:,[0,3]] > constants['DTCRIT_CONV']
+
+    # The first row, for the initial saturation with WaVa_feedback off
+    initial = _saved_rows(path, 'prognostic')[1](1)
+
+    # Replay the random numbers: after the six for the initial conditions,
+    # one per convecting box per timestep, box 1 before box 2
+    random = np.random.RandomState(int(saved['seed']))
+    random.normal(size=6)
+    for start in range(0, first, PROGNOSTIC_BLOCK):
+        random.normal(size=np.count_nonzero(convecting( read(min(PROGNOSTIC_BLOCK, first-start)) )))
+
+    for start in range(first, last, rows):
+        stop = min(start + rows, last)
+        prognostic = read(stop-start)
+
+        boxes = convecting(prognostic)
+        noise = np.zeros(boxes.shape)
+        noise[boxes] = random.normal(size=np.count_nonzero(boxes))
+
+        state = np.zeros( (stop-start, 21) )
+        state[:,PROGNOSTIC_COLS] = prognostic
+        state[:,14] = np.arange(start, stop) * dt_saved
+
+        # Use the constants of the simulation, restoring the current ones afterwards
+        with calc.overridden(**constants):
+            _calculate(state, initial[0], noise, Te1, Te2, WaVa)
+
+        yield state
+
+
+def _saved_rows(path, name):
+    """ Opens the 2D array 'name' saved in the .npz file 'path' to be read a
+        block of rows at a time, rather than all at once as np.load does.
+        Returns (number of rows, read), where read(n) returns the next n rows. """
+
+    f = zipfile.ZipFile(path).open(name + ".npy")
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    if len(shape) != 2:
+        raise ValueError("%s in %s isn't a 2D array" %(name, path))
+
+    if fortran_order:
+        # The rows aren't stored one after another (as in files saved by
+        # earlier versions), so the whole array has to be read
+        f.close()
+        array = np.load(path)[name]
+        position = [0]
+
+        def read(n):
+            position[0] += n
+            return array[position[0]-n:position[0]]
+
+    else:
+        def read(n):
+            return np.frombuffer(f.read(n * shape[1] * dtype.itemsize), dtype).reshape(-1, shape[1])
+
+    return shape[0], read
+
+
+def _calculate(state, initial, noise, Te1, Te2, WaVa):
+    """ Calculate the other variables in 'state' from the temperatures and CO2,
+        given the first row of the prognostic variables and the random numbers """
+
+    Ta1, Ts1, To1, Ta2, Ts2, To2, CO2 = [state[:,col] for col in PROGNOSTIC_COLS]
+
+    # Compute saturation water vapour pressure and specific humidity
+    esat1, qsat1 = calc.CLAUSIUS_CLAPEYRON_ARRAY(Ts1, Ta1)
+    esat2, qsat2 = calc.CLAUSIUS_CLAPEYRON_ARRAY(Ts2, Ta2)
+
+    # Emissivity
+    if WaVa == True:
+        epsa1 = calc.EPSA(esat1, qsat1, CO2)
+        epsa2 = calc.EPSA(esat2, qsat2, CO2)
+    else: # use initial values for saturation, humidity
+        esat1_init, qsat1_init = calc.CLAUSIUS_CLAPEYRON(initial[1], initial[0])
+        esat2_init, qsat2_init = calc.CLAUSIUS_CLAPEYRON(initial[4], initial[3])
+        epsa1 = calc.EPSA(esat1_init, qsat1_init, CO2)
+        epsa2 = calc.EPSA(esat2_init, qsat2_init, CO2)
+
+    # Circulation strengths
+    state[:,17], state[:,18] = calc.PSI(Ts1, Ts2)
+
+    # Moisture
+    state[:,6] = calc.MSE(Ts1, Ta1, qsat1)
+    state[:,13] = calc.MSE(Ts2, Ta2, qsat2)
+    state[:,19] = calc.MTSPT(state[:,17], qsat1, qsat2)
+
+    # Net surface heat flux
+    state[:,4], state[:,5] = calc.FS_ARRAY(Ts1, Ta1, Te1, epsa1, noise[:,0])
+    state[:,11], state[:,12] = calc.FS_ARRAY(Ts2, Ta2, Te2, epsa2, noise[:,1])
+
+    # Net top-of-atmosphere heat flux
+    state[:,3] = calc.FT(Ts1, Ta1, Te1, epsa1)
+    state[:,10] = calc.FT(Ts2, Ta2, Te2, epsa2)
+
+    # Global heat fluxes
+    state[:,15] = calc.FA(state[:,17], state[:,6], state[:,13])
+    state[:,16] = calc.FO(state[:,18], Ts1, To2)
+
+    return
@@ -0,0 +1,340 @@
+import os
+import sys
+import numpy as np
+
+from constants import *
+from params import *
+import calculations as calc
+import model
+from model import simulation_time, CO2_trajectory, make_save_loc
+from writer import write_array
+
+# N-box version of the model in model.py, selected by n_boxes in params.py.
+#
+# The hemisphere is split into n_boxes bands of equal area, from the equator
+# to the pole. Each box has the same atmosphere, mixed layer and thermocline
+# as the two-box model, and is coupled to its neighbours by the same
+# parameterisations of atmospheric and oceanic transport. Box variables are
+# arrays along the last axis, (timestep, box), and transport variables are
+# defined on the n_boxes-1 interfaces between neighbouring boxes, so that
+# each step costs O(n_boxes) array operations. n_boxes = 2 gives model.py.
+
+# Boundaries of the boxes in x = sin(latitude)
+X_EDGES = np.linspace(0, 1, n_boxes+1)
+
+# Area of each box (m2). For two boxes this is pi*RADIUS**2, which the fluxes
+# in calculations.py are normalised by.
+AREA = 2*np.pi*RADIUS**2 / n_boxes
+
+# Neighbouring boxes are closer together than the two boxes of the original
+# model by this factor. The contrasts in MSE and humidity carried by the
+# atmosphere are scaled by it, so the transports don't depend on resolution.
+RES = 0.5*n_boxes
+
+# Step the atmospheric heat transport forward implicitly (see
+# step_atm_implicit), rather than explicitly as in model.py. Needed for
+# stability with more than two boxes.
+implicit_atm = n_boxes > 2
+
+BOX_VARS = ('Ta', 'Ts', 'To', 'Ft', 'Fs', 'Feva', 'MSE')
+EDGE_VARS = ('Fa', 'Fo', 'Psia', 'Psio', 'MTspt')
+
+
+def emission_temperatures(nb):
+    """ Emission temperatures (in K) of nb equal area boxes between the equator
+        and the pole, generalising TEMI1 and TEMI2 in constants.py. """
+
+    lat = np.arcsin(np.linspace(0, 1, nb+1))
+
+    # Mean insolation over a band is (S0/pi) * int(cos(lat)**2) / int(cos(lat))
+    int_cos2 = 0.5*lat + 0.25*np.sin(2*lat)
+
+    return ( S0*(1-ALPHAp) * np.diff(int_cos2) / np.diff(np.sin(lat)) / (m.pi*SIGMA) )**.25
+
+
+def columns(nb):
+    """ Names of the columns of the state array, and of the saved data """
+
+    names = []
+    for var in BOX_VARS:
+        names += ["%s_%d" %(var, k) for k in range(nb)]
+    names += ['time']
+    for var in EDGE_VARS:
+        names += ["%s_%d" %(var, k) for k in range(nb-1)]
+    names += ['CO2']
+
+    return names
+
+
+def state_columns(nb=n_boxes):
+    """ Names of the columns of the state array of the model with nb boxes:
+        model.columns() for two boxes, otherwise columns(nb) """
+    if nb == 2:
+        return model.columns()
+    else:
+        return columns(nb)
+
+
+def as_data(state, nb=n_boxes):
+    """ Create dictionaries of views of the columns of a (timestep, variable) array """
+
+    boxes = {}
+    glob = {}
+    col = 0
+
+    # Box variables: arrays of size (timestep, box)
+    for var in BOX_VARS:
+        boxes[var] = state[:,col:col+nb]
+        col += nb
+
+    glob['time'] = state[:,col]     # simulation time in seconds
+    col += 1
+
+    # Transports between neighbouring boxes: arrays of size (timestep, box-1)
+    for var in EDGE_VARS:
+        glob[var] = state[:,col:col+nb-1]
+        col += nb-1
+
+    glob['CO2'] = state[:,col]      # Carbon dioxide
+
+    return boxes, glob
+
+
+def initialise():
+    """ Initialise the model using conditions specified in params.py. """
+
+    # The noise in the evaporation can't be replayed as for model.py
+    if save_format == 'prognostic':
+        raise ValueError("save_format = 'prognostic' is only for the two-box model")
+
+    if seed is not None:
+        np.random.seed(seed)
+
+    # As in model.py the whole simulation is held in one contiguous array,
+    # one row per timestep
+    state = np.zeros( (nt+1, len(columns(n_boxes))) )
+    boxes, glob = as_data(state)
+
+    boxes['Te'] = emission_temperatures(n_boxes)
+
+    glob['time'][:] = np.arange(nt+1)*dt
+
+    # Carbon dioxide trajectory given in params, as in model.py
+    glob['CO2'][:] = CO2_trajectory(nt, dt)
+
+    # Initial conditions: interpolate (in x) between the values specified in
+    # params.py for the centres of the two boxes, at x = 0.25 and 0.75,
+    # and add random noise of magnitude 'ic'.
+    x = 0.5*(X_EDGES[1:] + X_EDGES[:-1])
+    w = (x - 0.25) / 0.5
+    boxes['Ta'][0] = Ta1_init + w*(Ta2_init-Ta1_init) + ic*np.random.normal(size=n_boxes)
+    boxes['To'][0] = To1_init + w*(To2_init-To1_init) + ic*np.random.normal(size=n_boxes)
+    boxes['Ts'][0] = Ts1_init + w*(Ts2_init-Ts1_init) + ic*np.random.normal(size=n_boxes)
+
+    # Compute initial saturation water vapour pressure and specific humidity
+    # If water vapour feedback is turned off, this will be used again and again
+    boxes['esat_init'], boxes['qsat_init'] = calc.CLAUSIUS_CLAPEYRON_ARRAY(boxes['Ts'][0], boxes['Ta'][0])
+
+    return boxes, glob
+
+
+def update(n, boxes, glob):
+    """ Update other variables in the simulation after temperatures have been
+        stepped forward. """
+
+    Ts = boxes['Ts'][n]
+    Ta = boxes['Ta'][n]
+    To = boxes['To'][n]
+
+    # Compute saturation water vapour pressure and specific humidity
+    esat, qsat = calc.CLAUSIUS_CLAPEYRON_ARRAY(Ts, Ta)
+
+    # Emissivity calculations
+    if WaVa_feedback == True:
+        epsa = calc.EPSA(esat, qsat, glob['CO2'][n])
+    else: # use initial values for saturation, humidity
+        epsa = calc.EPSA(boxes['esat_init'], boxes['qsat_init'], glob['CO2'][n])
+
+    # Circulation strengths at the interfaces between neighbouring boxes, set
+    # by the contrast between the mean SST of all boxes on either side (for two
+    # boxes, Ts1 - Ts2). Using neighbouring SSTs instead would make upwelling
+    # depend on the curvature of SST from box to box, which is unstable
+    # unless dt shrinks as 1/n_boxes**2.
+    Ts_sum = np.cumsum(Ts)
+    Ts_eq = Ts_sum[:-1] / np.arange(1, n_boxes)
+    Ts_pole = (Ts_sum[-1] - Ts_sum[:-1]) / np.arange(n_boxes-1, 0, -1)
+    glob['Psia'][n], glob['Psio'][n] = calc.PSI(Ts_eq, Ts_pole)
+
+    # The transports below use the strength of the circulation only, as
+    # SSTs may not decrease monotonically towards the pole and the sign of
+    # Psia would carry heat and moisture against the gradient.
+    # (Identical to model.py while the tropics are warmer.)
+    Psia_abs = np.abs(glob['Psia'][n])
+    Psio_abs = np.abs(glob['Psio'][n])
+
+    # Moisture. The atmosphere exchanges air with the contrast in humidity and
+    # MSE over the distance between the two boxes of the original model.
+    boxes['MSE'][n] = calc.MSE(Ts, Ta, qsat)
+    glob['MTspt'][n] = RES * calc.MTSPT(Psia_abs, qsat[:-1], qsat[1:])
+
+    # Net surface heat flux
+    boxes['Fs'][n], boxes['Feva'][n] = calc.FS_ARRAY(Ts, Ta, boxes['Te'], epsa)
+
+    # Net top-of-atmosphere heat flux
+    boxes['Ft'][n] = calc.FT(Ts, Ta, boxes['Te'], epsa)
+
+    # Heat fluxes across the interfaces, per unit area of a box
+    MSE = boxes['MSE'][n]
+    glob['Fa'][n] = RES * calc.FA(Psia_abs, MSE[:-1], MSE[1:]) * (np.pi*RADIUS**2 / AREA)
+    glob['Fo'][n] = calc.FO(Psio_abs, Ts[:-1], To[1:]) * (np.pi*RADIUS**2 / AREA)
+
+    return
+
+
+def step(n, boxes, glob):
+    """ Step forward the temperatures. """
+
+    Ta = boxes['Ta'][n]
+    Ts = boxes['Ts'][n]
+    To = boxes['To'][n]
+    Fs = boxes['Fs'][n]
+
+    # Atmosphere: net heat transported into each box (no flux through the
+    # equator or the pole)
+    Fa = np.concatenate( ([0.], glob['Fa'][n], [0.]) )
+    Tend_atm = (Fs + boxes['Ft'][n] + Fa[:-1] - Fa[1:]) / HCA
+
+    if implicit_atm:
+        boxes['Ta'][n+1] = Ta + step_atm_implicit(Ta, Ts, dt*Tend_atm, np.abs(glob['Psia'][n]))
+    else:
+        boxes['Ta'][n+1] = Ta + dt*Tend_atm
+
+    # Ocean: surface water flows poleward at each interface and returns
+    # equatorward in the thermocline. Rescale Psio (kg/s -> W m-2 K-1);
+    # P[k] is the flow into box k from the box on its equatorward side.
+    P = np.concatenate( ([0.], np.abs(glob['Psio'][n]) * CPO / AREA, [0.]) )
+
+    # Where more leaves a box poleward than enters it, the difference upwells
+    # from the thermocline, otherwise it sinks into the thermocline
+    up = np.maximum(P[1:] - P[:-1], 0)
+    down = np.maximum(P[:-1] - P[1:], 0)
+
+    # Temperatures of the neighbouring boxes (the padding is multiplied by P = 0)
+    Ts_eq = np.concatenate( ([0.], Ts[:-1]) )
+    To_pole = np.concatenate( (To[1:], [0.]) )
+
+    # Surface - mixed layer
+    Tend_oce_ml = -( Fs - up*(To - Ts) - P[:-1]*(Ts_eq - Ts) ) / HCM
+
+    boxes['Ts'][n+1] = Ts + dt*Tend_oce_ml
+
+    # Ocean - thermocline
+    Tend_oce_th = ( P[1:]*(To_pole - To) + down*(Ts - To) ) / HCO
+
+    boxes['To'][n+1] = To + dt*Tend_oce_th
+
+    return
+
+
+def step_atm_implicit(Ta, Ts, dTa, Psia_abs):
+    """ Returns the change in atmospheric temperature over a timestep, given the
+        explicit change dTa, with the heat transport between boxes treated
+        implicitly.
+
+        The transport acts like diffusion with a coefficient proportional to
+        n_boxes**2, so stepping it forward explicitly would need dt to shrink
+        as 1/n_boxes**2. Here it's linearised about the current MSE,
+        Fa_k = c_k * (MSE_k - MSE_k+1), and the resulting tridiagonal system is
+        solved in O(n_boxes). """
+
+    # Exchange coefficient at each interface, as in update()
+    c = RES * Psia_abs / AREA
+
+    # Sensitivity of MSE to the atmospheric temperature
+    esat, qsat = calc.CLAUSIUS_CLAPEYRON_ARRAY(Ts, Ta)
+    esat, qsat_plus = calc.CLAUSIUS_CLAPEYRON_ARRAY(Ts, Ta+1.)
+    b = calc.MSE(Ts, Ta+1., qsat_plus) - calc.MSE(Ts, Ta, qsat) # J kg-1 K-1
+
+    # (1 + transport out) * change - transport in = explicit change
+    k = dt / HCA
+    lower = -k * c * b[:-1]     # coefficient of the box on the equatorward side
+    upper = -k * c * b[1:]      # coefficient of the box on the poleward side
+    diag = 1 + k * b * ( np.concatenate( ([0.], c) ) + np.concatenate( (c, [0.]) ) )
+
+    return _solve_tridiagonal(lower, diag, upper, dTa)
+
+
+def _solve_tridiagonal(lower, diag, upper, rhs):
+    """ Thomas algorithm for a tridiagonal system: O(n), and numerically stable
+        for the diagonally dominant systems in step_atm_implicit. """
+
+    # Python floats are much quicker than numpy scalars in this loop
+    lower, diag, upper, rhs = lower.tolist(), diag.tolist(), upper.tolist(), rhs.tolist()
+    nb = len(diag)
+
+    # Forward elimination
+    for k in range(1, nb):
+        w = lower[k-1] / diag[k-1]
+        diag[k] -= w * upper[k-1]
+        rhs[k] -= w * rhs[k-1]
+
+    # Back substitution
+    x = [0.] * nb
+    x[-1] = rhs[-1] / diag[-1]
+    for k in range(nb-2, -1, -1):
+        x[k] = (rhs[k] - upper[k] * x[k+1]) / diag[k]
+
+    return np.array(x)
+
+
+def settable():
+    """ Constants which can be changed by setting them in calculations.py
+        (see calc.settable) """
+    return calc.settable(initialise, update, step, step_atm_implicit, emission_temperatures)
+
+
+def save(n, boxes, glob, writer=None):
+    """ Save time series data, in the background if given a writer.BackgroundWriter
+        (see model.save). """
+
+    # Create the directory if it doesn't exist
+    make_save_loc()
+
+    # (row,col) = (timestep,variable), contiguous as in model.save
+    state = boxes['Ta'].base[:n]
+
+    if writer is None:
+        write = write_array
+    else:
+        write = writer.write
+
+    if save_format == 'npy':
+        write(save_loc + "nbox.npy", state)
+    else:
+        write(save_loc + "nbox.out", state, header=" ".join(columns(n_boxes)))
+
+    return
+
+
+def load_data(loc):
+    """ Load output data from an N-box simulation, from loc/nbox.npy or loc/nbox.out """
+
+    if os.path.exists(loc+"nbox.npy"):
+        state = np.load(loc+"nbox.npy", mmap_mode='r')
+    else:
+        state = np.loadtxt(loc+"nbox.out")
+
+    # Number of boxes from number of columns: 7*nb + 1 + 5*(nb-1) + 1
+    nb = (state.shape[1] + 3) // 12
+
+    return as_data(state, nb)
+
+
+def selected():
+    """ The model selected by n_boxes in params.py: model.py, the two-box
+        model described in the documentation, or the N-box version in this
+        module. Both have the same initialise, update, step and save. """
+
+    if n_boxes == 2:
+        return model
+    return sys.modules[__name__]
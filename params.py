@@ -3,6 +3,26 @@ from constants import *
 # Directory for saving (relative path)
 save_loc = "control/"
 
+# Format of the saved time series
+""" 'txt'        - text files box1.out, box2.out, global.out
+    'npy'        - a single binary file state.npy, which is much quicker to save and load
+    'prognostic' - a single binary file prognostic.npz of just the temperatures, CO2 and
+                   the seed for the random noise, a third of the size of state.npy. The
+                   other variables are calculated from them when they're loaded
+                   (two-box model only). """
+save_format = 'txt'
+
+# Seed for the random numbers (the noise in the initial conditions and evaporation),
+# or None for a different simulation each time. With save_format = 'prognostic' one
+# is picked at random if it's None, and saved.
+seed = None
+
+
+# Number of boxes between the equator and the pole. 2 gives the tropics and
+# extra-tropics model described in the documentation, more give finer
+# latitude resolution (see nbox.py).
+n_boxes = 2
+
 
 # ----------------- #
 #  Simulation time  #
@@ -10,7 +30,7 @@ save_loc = "control/"
 # Number of years to run the simulation
 nyr = 500
 
-# Timestep (< 2 days for stability)
+# Timestep (< 2 days for stability, see convergence.py for the accuracy)
 dt = float(1*DAY)
 
 # Number of timesteps
@@ -63,3 +83,11 @@ tau_CO2 = float(100*YEAR)
 # Include water vapour feedback (True/False)
 WaVa_feedback = False
 
+
+# ------- #
+#  Hooks  #
+# ------- #
+# Name of a module which registers functions to be called during the
+# simulation (see hooks.py), or None
+hooks_module = None
+
@@ -1,10 +1,19 @@
+import os
+import re
+import hashlib
+import inspect
+import multiprocessing
 import numpy as np
+import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.backends.backend_pdf as mpl_pdf
-from sys import argv
+from matplotlib.lines import Line2D
+from sys import argv, exit
 
 from constants import *
 from params import *
+import constants
+import model
 
 # Set default plotting parameters
 plt.rcParams['xtick.direction'] = 'in'
@@ -37,13 +46,11 @@ cs = {
       'tot': 'red',
       } 
 
-def load_data(loc):
-    """ Load output data from a simulation, from loc/box1.out, loc/box2.out, loc/glob.out """
+def as_data(box1_arr, box2_arr, glob_arr):
+    """ Arrange (timestep, variable) arrays, as saved by model.save, into dictionaries """
     # ------- #
     #  Box 1  #
     # ------- #
-    box1_arr = np.loadtxt(loc+"box1.out")
-    
     box1 = {'Ta': box1_arr[:,0],         # Atmospheric temperature
             'Ts': box1_arr[:,1],         # Surface temperature
             'To': box1_arr[:,2],         # Oceanic temperature
@@ -57,8 +64,6 @@ def load_data(loc):
     # ------- #
     #  Box 2  #
     # ------- #
-    box2_arr = np.loadtxt(loc+"box2.out")
-    
     box2 = {'Ta': box2_arr[:,0],         # Atmospheric temperature
             'Ts': box2_arr[:,1],         # Surface temperature
             'To': box2_arr[:,2],         # Oceanic temperature
@@ -72,8 +77,6 @@ def load_data(loc):
     # ------------- #
     #  Global data  #
     # ------------- #
-    glob_arr = np.loadtxt(loc+"global.out")
-    
     glob = {'time': glob_arr[:,0],       # simulation time in seconds
             'Fa' : glob_arr[:,1],        # Atmospheric flux
             'Fo' : glob_arr[:,2],        # Oceanic flux
@@ -86,38 +89,263 @@ def load_data(loc):
     return box1, box2, glob
 
 
+# Variables in each of the saved files, in the order of their columns
+BOX_VARS = model.BOX_VARS
+GLOB_VARS = model.GLOB_VARS
+
+
+def load_data(loc, years=None, variables=None):
+    """ Load output data from a simulation, from loc/state.npy or
+        loc/prognostic.npz if it was saved in binary, otherwise from
+        loc/box1.out, loc/box2.out, loc/global.out
+
+        years       - (first, last) simulation years to load, either of which
+                      may be None. By default the whole simulation is loaded.
+        variables   - names of the saved variables to load, e.g. 'box1.Ta',
+                      'glob.CO2' (see figure_vars). By default all of them.
+                      glob['time'] is always loaded.
+
+        Only the rows in 'years' are parsed (text), read (binary) or
+        calculated (prognostic). Files with none of 'variables' in them
+        aren't opened at all. Raises ValueError if there are no rows in
+        'years'. """
+
+    if variables is None:
+        variables = model.columns()
+
+    files = (("box1.out", 'box1', BOX_VARS), ("box2.out", 'box2', BOX_VARS), ("global.out", 'glob', GLOB_VARS))
+    data = {'box1': {'Te': Te1}, 'box2': {'Te': Te2}, 'glob': {}}
+
+    binary = os.path.exists(loc+"state.npy")
+    prognostic = os.path.exists(loc+"prognostic.npz")
+    if binary:
+        # Memory-mapped rather than read, so only the rows used are read from disk
+        state = np.load(loc+"state.npy", mmap_mode='r')
+        time = state[:,14]
+    elif prognostic:
+        saved = np.load(loc+"prognostic.npz")
+        time = np.arange( min(2, len(saved['prognostic'])) ) * float(saved['dt'])
+    else:
+        time = _read_rows(loc+"global.out", 0, 2)[:,0]
+
+    # Rows in the time window, given the (constant) timestep of the simulation
+    first, last = 0, None
+    if len(time) > 1:
+        first, last = rows_in(years, time[0], time[1] - time[0])
+
+    # The other variables are calculated from the temperatures, just for the window
+    if prognostic and not binary:
+        state = model.load_prognostic(loc+"prognostic.npz", first, last)
+        first, last = 0, None
+        binary = True
+
+    for i, (fname, name, names) in enumerate(files):
+        cols = [col for col, var in enumerate(names) if name+'.'+var in variables or var == 'time']
+        if not cols:
+            continue
+
+        if binary:
+            arr = state[first:last, 7*i:7*i+7]
+        else:
+            arr = _read_rows(loc+fname, first, last)
+
+        for col in cols:
+            data[name][names[col]] = arr[:,col]
+
+    # Nothing saved in the window (e.g. it starts after the end of the run)
+    if len(data['glob']['time']) == 0:
+        first, last = years or (None, None)
+        raise ValueError("No output saved in %s from year %s to %s" %(loc or "./",
+                         "0" if first is None else "%g" %first, "the end" if last is None else "%g" %last))
+
+    return data['box1'], data['box2'], data['glob']
+
+
+def rows_in(years, time0, step, nrows=None):
+    """ First and last (exclusive) rows of a simulation in 'years', (first,
+        last) simulation years either of which may be None, given the time of
+        its first row and its (constant) timestep. If the number of rows
+        'nrows' isn't given, last is None for the end of the simulation. """
+
+    first, last = 0, nrows
+    if years is not None:
+        if years[0] is not None:
+            first = max(0, int(np.ceil( (years[0]*YEAR - time0) / step - 1e-6 )))
+        if years[1] is not None:
+            last = int(np.floor( (years[1]*YEAR - time0) / step + 1e-6 )) + 1
+            if nrows is not None:
+                last = min(nrows, last)
+
+    if last is not None:
+        last = max(first, last)
+    return first, last
+
+
+def years_arg(arg):
+    """ (first, last) simulation years from a command-line argument
+        years=first:last, either of which can be left out """
+
+    first, sep, last = arg[len('years='):].partition(':')
+    return (float(first) if first else None, float(last) if last else None)
+
+
+def _read_rows(path, first, last=None, ncols=7):
+    """ Parse rows first, ..., last-1 of a text file written by np.savetxt.
+        The rows before 'first' are skipped by counting line breaks rather
+        than being parsed, and reading stops after row 'last'. """
+
+    chunk_size = 1 << 22
+    f = open(path, 'rb')
+
+    def skip(nrows):
+        """ Return the data up to the end of the next nrows rows (or of the file) """
+        chunks = []
+        while nrows > 0:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            count = chunk.count(b'\n')
+            if count >= nrows:
+                # Rewind to the end of the row we're looking for
+                end = -1
+                for k in range(nrows):
+                    end = chunk.index(b'\n', end+1)
+                f.seek(end + 1 - len(chunk), 1)
+                chunk = chunk[:end+1]
+            nrows -= count
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    skip(first)
+    if last is None:
+        data = f.read()
+    else:
+        data = skip(last - first)
+    f.close()
+
+    return np.fromstring(data, sep=' ').reshape(-1, ncols)
+
+
+###########################
+##  Plotted time series  ##
+###########################
+
+# Every line in the figures below is one of these series, computed from a
+# Derived (see below) and tagged with its key as the line's gid.
+# All of them are elementwise in time (the 'change in heat content' series
+# only refer back to the first row), which is what allows watch() to extend
+# a line using just the rows appended since the last refresh.
+# Constant factors are grouped so that each series costs a single temporary.
+series = {
+    'time': lambda d: d.glob['time'] * (1./YEAR),
+    'CO2': lambda d: d.glob['CO2'],
+
+    # Transport
+    'Fa_PW': lambda d: d.glob['Fa'] * (np.pi*RADIUS**2 / PW),
+    'Fo_PW': lambda d: d.glob['Fo'] * (np.pi*RADIUS**2 / PW),
+    'Ftot_PW': lambda d: d['Fa_PW'] + d['Fo_PW'],
+    'Psia_SV': lambda d: d.glob['Psia'] * (1./SV),
+    'Psio_SV': lambda d: d.glob['Psio'] * (1./SV),
+    'MTspt_SV': lambda d: d.glob['MTspt'] * (1./SV),
+
+    # Hydrological cycle: evaporation, precipitation in 10^9 kg/s, spec. humidity in kg/kg
+    'evap1_SV': lambda d: d.box1['Feva'] * (np.pi*RADIUS**2 / (LV*SV)),
+    'evap2_SV': lambda d: d.box2['Feva'] * (np.pi*RADIUS**2 / (LV*SV)),
+    'prcp1_SV': lambda d: d['evap1_SV'] - d['MTspt_SV'],
+    'prcp2_SV': lambda d: d['evap2_SV'] + d['MTspt_SV'],
+    'q1': lambda d: (d.box1['MSE'] - CPA*d['Tsa1']) / LV,
+    'q2': lambda d: (d.box2['MSE'] - CPA*d['Tsa2']) / LV,
+
+    # Heat content (atmos, mixed layer, thermocline) in 10^9 J m-2, MSE in 10^6 J m-2
+    'hc1_at': lambda d: d.box1['Ta'] * (HCA/SV),
+    'hc2_at': lambda d: d.box2['Ta'] * (HCA/SV),
+    'hc1_ml': lambda d: d.box1['Ts'] * (HCM/SV),
+    'hc2_ml': lambda d: d.box2['Ts'] * (HCM/SV),
+    'hc1_th': lambda d: d.box1['To'] * (HCO/SV),
+    'hc2_th': lambda d: d.box2['To'] * (HCO/SV),
+    'MSE1_MJ': lambda d: d.box1['MSE'] * 1e-6,
+    'MSE2_MJ': lambda d: d.box2['MSE'] * 1e-6,
+
+    # Change in heat content since the start of the simulation
+    'dhc1_at': lambda d: d['hc1_at'] - d['hc1_at'][0],
+    'dhc2_at': lambda d: d['hc2_at'] - d['hc2_at'][0],
+    'dhc1_ml': lambda d: d['hc1_ml'] - d['hc1_ml'][0],
+    'dhc2_ml': lambda d: d['hc2_ml'] - d['hc2_ml'][0],
+    'dhc1_th': lambda d: d['hc1_th'] - d['hc1_th'][0],
+    'dhc2_th': lambda d: d['hc2_th'] - d['hc2_th'][0],
+
+    # Averages over the two boxes
+    'Ta_av': lambda d: 0.5*(d.box1['Ta']+d.box2['Ta']),
+    'Ts_av': lambda d: 0.5*(d.box1['Ts']+d.box2['Ts']),
+    'To_av': lambda d: 0.5*(d.box1['To']+d.box2['To']),
+
+    # Averages of atmospheric and surface temperature in each box
+    'Tsa1': lambda d: 0.5*(d.box1['Ta']+d.box1['Ts']),
+    'Tsa2': lambda d: 0.5*(d.box2['Ta']+d.box2['Ts']),
+    }
+
+# Variables saved by model.save are plotted as they are, e.g. 'box1.Ta'
+for var in ('Ta', 'Ts', 'To', 'Ft', 'Fs', 'Feva', 'MSE'):
+    series['box1.'+var] = lambda d, var=var: d.box1[var]
+    series['box2.'+var] = lambda d, var=var: d.box2[var]
+
+
+class Derived(object):
+    """ Series derived from one set of simulation data. Each one is computed
+        the first time it's asked for, d['Fa_PW'] say, and then remembered,
+        so figures drawing the same quantity share a single array. """
+
+    def __init__(self, box1, box2, glob):
+        self.box1 = box1
+        self.box2 = box2
+        self.glob = glob
+        self._cache = {}
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            self._cache[key] = series[key](self)
+        return self._cache[key]
+
+
+def plot_series(ax, key, d, *args, **kwargs):
+    """ Plot one of the above series against time in years, tagging the line with its key """
+
+    return ax.plot(d['time'], d[key], *args, gid=key, **kwargs)
+
+
 #####################################
 ##  Plotting function definitions  ##
 #####################################
 
-def temperatures(box1, box2, glob):
+def temperatures(box1, box2, glob, d=None):
     """ Plot all individual temperatures from both boxes. 
 
                     python plot.py temps              """
 
-    time = glob['time'] / YEAR
+    if d is None:
+        d = Derived(box1, box2, glob)
 
     fig, ((ax1, ax2), (ax3, ax4), (ax5, ax6)) = plt.subplots(3, 2, sharex='all')
     fig.suptitle("Temperatures")
 
     ax1.set_title("Tropics")
     ax1.set_ylabel("Temperature (K)")
-    atm, = ax1.plot(time, box1['Ta'], color=cs['atm'], label="Atm.")
+    atm, = plot_series(ax1, 'box1.Ta', d, color=cs['atm'], label="Atm.")
 
     ax2.set_title("Extra-Tropics")
-    ax2.plot(time, box2['Ta'], color=cs['atm'])
+    plot_series(ax2, 'box2.Ta', d, color=cs['atm'])
     
     ax3.set_ylabel("Temperature (K)")
-    surf, = ax3.plot(time, box1['Ts'], color=cs['surf'], label="Surf.")
+    surf, = plot_series(ax3, 'box1.Ts', d, color=cs['surf'], label="Surf.")
 
-    ax4.plot(time, box2['Ts'], color=cs['surf'])
+    plot_series(ax4, 'box2.Ts', d, color=cs['surf'])
 
     ax5.set_xlabel("Time (years)")
     ax5.set_ylabel("Temperature (K)")
-    oce, = ax5.plot(time, box1['To'], color=cs['oce'], label="Oce.")
+    oce, = plot_series(ax5, 'box1.To', d, color=cs['oce'], label="Oce.")
 
     ax6.set_xlabel("Time (years)")
-    ax6.plot(time, box2['To'], color=cs['oce'])
+    plot_series(ax6, 'box2.To', d, color=cs['oce'])
    
     handles = [atm, surf, oce]
     labels = [h.get_label() for h in handles]
@@ -128,38 +356,39 @@ def temperatures(box1, box2, glob):
     return fig
 
 
-def transport(box1, box2, glob):
+def transport(box1, box2, glob, d=None):
     """ Plot heat and moisture transport and circulation strength.
             
                     python plot.py transport        """
 
-    time = glob['time'] / YEAR
+    if d is None:
+        d = Derived(box1, box2, glob)
 
     fig, ((ax1, ax2), (ax3, ax4), (ax5, ax6)) = plt.subplots(3, 2, sharex='all')
     fig.suptitle("Transport")
 
     ax1.set_title("Heat transport")
     ax1.set_ylabel("Power ($10^{15}W$)")
-    atm, = ax1.plot(time, (glob['Fa'] * np.pi*RADIUS**2) / PW, color=cs['atm'], label="Atm.")
+    atm, = plot_series(ax1, 'Fa_PW', d, color=cs['atm'], label="Atm.")
 
     ax2.set_title("Circulation strength")
     ax2.set_ylabel("Flow ($10^9 kg/s$)")
-    ax2.plot(time, glob['Psia'] / SV, color=cs['atm'])
+    plot_series(ax2, 'Psia_SV', d, color=cs['atm'])
     
     ax3.set_ylabel("Power ($10^{15}W$)")
-    oce, = ax3.plot(time, (glob['Fo'] * np.pi*RADIUS**2) / PW, color=cs['oce'], label="Oce.")
+    oce, = plot_series(ax3, 'Fo_PW', d, color=cs['oce'], label="Oce.")
 
     ax4.set_ylabel("Flow ($10^9 kg/s$)")
-    ax4.plot(time, glob['Psio'] / SV, color=cs['oce'])
+    plot_series(ax4, 'Psio_SV', d, color=cs['oce'])
 
     ax5.set_xlabel("Time (years)")
     ax5.set_ylabel("Power ($10^{15}W$)")
-    atmoce, = ax5.plot(time, ((glob['Fo']+glob['Fa']) * np.pi*RADIUS**2) / PW, color=cs['oatot'], label="Atm.+Oce.")
+    atmoce, = plot_series(ax5, 'Ftot_PW', d, color=cs['oatot'], label="Atm.+Oce.")
 
     ax6.set_title("Moisture transport")
     ax6.set_xlabel("Time (years)")
     ax6.set_ylabel("Flow ($10^9 kg/s$)")
-    ax6.plot(time, glob['MTspt'] / SV, color=cs['x'])
+    plot_series(ax6, 'MTspt_SV', d, color=cs['x'])
    
     handles = [atm, oce, atmoce]
     labels = [h.get_label() for h in handles]
@@ -170,108 +399,83 @@ def transport(box1, box2, glob):
     return fig
 
 
-def hydro(box1, box2, glob):
+def hydro(box1, box2, glob, d=None):
     """ Plot hydrological cycle (except moisture transport which in in 'transport')
                     
                     python plot.py hydro            """
 
-    time = glob['time'] / YEAR
+    if d is None:
+        d = Derived(box1, box2, glob)
 
-    # Box 1
-    evap1 = box1['Feva'] * (np.pi*RADIUS**2) / LV           # Evaporation in kg/s
-    prcp1 = evap1 - glob['MTspt']                           # Precipitation in kg/s
-    prcp1_mmday = (1000*prcp1*DAY) / (RHO*np.pi*RADIUS**2)  # in mm/day
-    q1 = (box1['MSE'] - CPA*0.5*(box1['Ta']+box1['Ts']))/LV # Low level spec. humidity in kg/kg
-    
-    # Box 2
-    evap2 = box2['Feva'] * (np.pi*RADIUS**2) / LV           # Evaporation in kg/s
-    prcp2 = evap2 + glob['MTspt']                           # Precipitation in kg/s
-    prcp2_mmday = (1000*prcp2*DAY) / (RHO*np.pi*RADIUS**2)  # in mm/day
-    q2 = (box2['MSE'] - CPA*0.5*(box2['Ta']+box2['Ts']))/LV # Low level spec. humidity in kg/kg
-    
     fig, ((ax1, ax2), (ax3, ax4), (ax5, ax6)) = plt.subplots(3, 2, sharex='all')
     fig.suptitle("Hydrological cycle")
 
     ax1.set_title("Tropics")
     ax1.set_ylabel("Evaporation\n($10^9$ kg/s)")
-    ax1.plot(time, evap1 / SV, color=cs['T'], label="Trop.")
+    plot_series(ax1, 'evap1_SV', d, color=cs['T'], label="Trop.")
     
     ax2.set_title("Extra-Tropics")
-    ax2.plot(time, evap2 / SV, color=cs['ET'], label="E-Trop.")
+    plot_series(ax2, 'evap2_SV', d, color=cs['ET'], label="E-Trop.")
 
     ax3.set_ylabel("Precipitation\n($10^9$ kg/s)")
-    ax3.plot(time, prcp1 / SV, color=cs['T2'], label="Trop.")
+    plot_series(ax3, 'prcp1_SV', d, color=cs['T2'], label="Trop.")
     
-    ax4.plot(time, prcp2 / SV, color=cs['ET2'], label="E-Trop.")
+    plot_series(ax4, 'prcp2_SV', d, color=cs['ET2'], label="E-Trop.")
 
     ax5.set_xlabel("Time (years)")
     ax5.set_ylabel("Specific humidity\n(kg/kg)")
-    ax5.plot(time, q1, color=cs['T3'], label="Trop.")
+    plot_series(ax5, 'q1', d, color=cs['T3'], label="Trop.")
     
     ax6.set_xlabel("Time (years)")
-    ax6.plot(time, q2, color=cs['ET3'], label="E-Trop.")
+    plot_series(ax6, 'q2', d, color=cs['ET3'], label="E-Trop.")
 
     fig.tight_layout(rect=[0,0.03,1,0.95])
 
     return fig
 
 
-def fluxes(box1, box2, glob):
+def fluxes(box1, box2, glob, d=None):
     """ Plot vertical fluxes
 
                     python plot.py flux         """
 
-    time = glob['time'] / YEAR
-    
+    if d is None:
+        d = Derived(box1, box2, glob)
+
     fig, ((ax1, ax2), (ax3, ax4), (ax5, ax6)) = plt.subplots(3, 2, sharex='all')
     fig.suptitle("Fluxes")
 
     ax1.set_title("Tropics")
     ax1.set_ylabel("TOA flux\n($Wm^{-2}$)")
-    ax1.plot(time, box1['Ft'], color=cs['T'], label="Trop.")
+    plot_series(ax1, 'box1.Ft', d, color=cs['T'], label="Trop.")
     
     ax2.set_title("Extra-Tropics")
-    ax2.plot(time, box2['Ft'], color=cs['ET'], label="E-Trop")
+    plot_series(ax2, 'box2.Ft', d, color=cs['ET'], label="E-Trop")
 
     ax3.set_ylabel("Surf. heat flux\n($Wm^{-2}$)")
-    ax3.plot(time, box1['Fs'], color=cs['T2'], label="Trop.")
+    plot_series(ax3, 'box1.Fs', d, color=cs['T2'], label="Trop.")
     
-    ax4.plot(time, box2['Fs'], color=cs['ET2'], label="E-Trop")
+    plot_series(ax4, 'box2.Fs', d, color=cs['ET2'], label="E-Trop")
 
     ax5.set_xlabel("Time (years)")
     ax5.set_ylabel("Evap. flux\n($Wm^{-2}$)")
-    ax5.plot(time, box1['Feva'], color=cs['T3'], label="Trop.")
+    plot_series(ax5, 'box1.Feva', d, color=cs['T3'], label="Trop.")
     
     ax6.set_xlabel("Time (years)")
-    ax6.plot(time, box2['Feva'], color=cs['ET3'], label="E-Trop")
+    plot_series(ax6, 'box2.Feva', d, color=cs['ET3'], label="E-Trop")
 
     fig.tight_layout(rect=[0,0.03,1,0.95])
     
     return fig
 
 
-def energy(box1, box2, glob):
+def energy(box1, box2, glob, d=None):
     """ Plot energy content
 
                 python plot.py energy           """
 
-    time = glob['time'] / YEAR
-
-    # Compute heat content
-    hc1_at = HCA * box1['Ta']       # atmos?
-    hc1_ml = HCM * box1['Ts']       # mixed layer
-    hc1_th = HCO * box1['To']       # thermocline
-    hc1_tot = hc1_ml + hc1_th       # oce. total for box 1
-
-    hc2_at = HCA * box2['Ta']       # atmos?
-    hc2_ml = HCM * box2['Ts']       # mixed layer
-    hc2_th = HCO * box2['To']       # thermocline
-    hc2_tot = hc2_ml + hc2_th       # oce. total for box 2
-    
-    hc_tot = hc1_tot + hc2_tot      # oce. global total
-    hc_tot_at = hc1_at + hc2_at      # atm. global total
-
-    MSE_tot = box1['MSE'] + box2['MSE']
+    if d is None:
+        d = Derived(box1, box2, glob)
 
     fig, ((ax1, ax2), (ax3, ax4), (ax5, ax6), (ax7, ax8)) \
             = plt.subplots(4, 2, sharex='all')
@@ -279,57 +483,57 @@ def energy(box1, box2, glob):
 
     ax1.set_title("Tropics")
     ax1.set_ylabel("Atmosphere\n($10^9 Jm^{-2}$)")
-    ax1.plot(time, hc1_at / SV, color=cs['T'], label="Trop.")
+    plot_series(ax1, 'hc1_at', d, color=cs['T'], label="Trop.")
     
     ax2.set_title("Extra-Tropics")
-    ax2.plot(time, hc2_at / SV, color=cs['ET'], label="E-Trop.")
+    plot_series(ax2, 'hc2_at', d, color=cs['ET'], label="E-Trop.")
     
     ax3.set_ylabel("Mixed Layer\n($10^9 Jm^{-2}$)")
-    ax3.plot(time, hc1_ml / SV, color=cs['T2'], label="Trop.")
+    plot_series(ax3, 'hc1_ml', d, color=cs['T2'], label="Trop.")
     
-    ax4.plot(time, hc2_ml / SV, color=cs['ET2'], label="E-Trop.")
+    plot_series(ax4, 'hc2_ml', d, color=cs['ET2'], label="E-Trop.")
 
     ax5.set_ylabel("Thermocline\n($10^9 Jm^{-2}$)")
-    ax5.plot(time, hc1_th / SV, color=cs['T3'], label="Trop.")
+    plot_series(ax5, 'hc1_th', d, color=cs['T3'], label="Trop.")
     
-    ax6.plot(time, hc2_th / SV, color=cs['ET3'], label="E-Trop.")
+    plot_series(ax6, 'hc2_th', d, color=cs['ET3'], label="E-Trop.")
     
     ax7.set_xlabel("Time (years)")
     ax7.set_ylabel("Moist static energy\n($10^6 Jm^{-2}$)")
-    ax7.plot(time, box1['MSE'] / 1e6, color=cs['T4'], label="Trop.")
+    plot_series(ax7, 'MSE1_MJ', d, color=cs['T4'], label="Trop.")
     
     ax8.set_xlabel("Time (years)")
-    ax8.plot(time, box2['MSE'] / 1e6, color=cs['ET4'], label="E-Trop.")
+    plot_series(ax8, 'MSE2_MJ', d, color=cs['ET4'], label="E-Trop.")
 
     fig.tight_layout(rect=[0,0.03,1,0.95])
 
     return fig
 
 
-def carbon_dioxide(box1, box2, glob):
+def carbon_dioxide(box1, box2, glob, d=None):
     """ Plot carbon dioxide concentration and global temperature
                     python plot.py co2              """
 
+    if d is None:
+        d = Derived(box1, box2, glob)
 
-    time = glob['time'] / YEAR
-    
     fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, sharex='all')
     
     ax1.set_title("Carbon dioxide")
     ax1.set_ylabel("Concentration (ppm)")
-    ax1.plot(time, glob['CO2'], color=cs['x'])
+    plot_series(ax1, 'CO2', d, color=cs['x'])
 
     ax2.set_title("Average temperature")
     ax2.set_ylabel("Temperature (K)")
-    atm, = ax2.plot(time, 0.5*(box1['Ta']+box2['Ta']), color=cs['atm'], label="Atm.")
+    atm, = plot_series(ax2, 'Ta_av', d, color=cs['atm'], label="Atm.")
     
     ax3.set_title("Average temperature")
     ax3.set_xlabel("Time (years)")
     ax3.set_ylabel("Temperature (K)")
-    surf, = ax3.plot(time, 0.5*(box1['Ts']+box2['Ts']), color=cs['surf'], label="Surf.")
+    surf, = plot_series(ax3, 'Ts_av', d, color=cs['surf'], label="Surf.")
     
     ax4.set_xlabel("Time (years)")
-    oce, = ax4.plot(time, 0.5*(box1['To']+box2['To']), color=cs['oce'], label="Oce.")
+    oce, = plot_series(ax4, 'To_av', d, color=cs['oce'], label="Oce.")
 
     handles = [atm, surf, oce]
     labels = [h.get_label() for h in handles]
@@ -340,92 +544,81 @@ def carbon_dioxide(box1, box2, glob):
     return fig
 
 
-def ocean(box1, box2, glob):
+def ocean(box1, box2, glob, d=None):
     """ Plot things to do with the ocean
 
                 python plot.py ocean            """
 
-    time = glob['time'] / YEAR
-    
-    # Compute heat content
-    hc1_ml = HCM * box1['Ts']       # mixed layer
-    hc1_th = HCO * box1['To']       # thermocline
-    hc1_tot = hc1_ml + hc1_th       # total for box 1
-
-    hc2_ml = HCM * box2['Ts']       # mixed layer
-    hc2_th = HCO * box2['To']       # thermocline
-    hc2_tot = hc2_ml + hc2_th       # total for box 2
+    if d is None:
+        d = Derived(box1, box2, glob)
 
     fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, sharex='all')
     fig.suptitle("Ocean")
 
     ax1.set_title("Sea Surface Temperatures")
     ax1.set_ylabel("Temperature (K)")
-    ax1.plot(time, box1['Ts'], color=cs['T'], label="Trop.")
-    ax1.plot(time, box2['Ts'], color=cs['ET'], label="E-Trop.")
-    ax1.plot(time, 0.5*(box1['Ts']+box2['Ts']), color=cs['av'], label="Av.")
+    plot_series(ax1, 'box1.Ts', d, color=cs['T'], label="Trop.")
+    plot_series(ax1, 'box2.Ts', d, color=cs['ET'], label="E-Trop.")
+    plot_series(ax1, 'Ts_av', d, color=cs['av'], label="Av.")
 
     ax2.set_title("Ocean Temperatures")
     ax2.set_ylabel("Temperature (K)")
-    ax2.plot(time, box1['To'], color=cs['T'], label="Trop.")
-    ax2.plot(time, box2['To'], color=cs['ET'], label="E-Trop.")
-    ax2.plot(time, 0.5*(box1['To']+box2['To']), color=cs['av'], label="Av.")
+    plot_series(ax2, 'box1.To', d, color=cs['T'], label="Trop.")
+    plot_series(ax2, 'box2.To', d, color=cs['ET'], label="E-Trop.")
+    plot_series(ax2, 'To_av', d, color=cs['av'], label="Av.")
     ax2.legend()
 
     ax3.set_title("Heat transport")
     ax3.set_xlabel("Time (years)")
     ax3.set_ylabel("Power ($10^{15}W$)")
-    ax3.plot(time, (glob['Fo'] * np.pi*RADIUS**2) / PW, color=cs['x'])
+    plot_series(ax3, 'Fo_PW', d, color=cs['x'])
 
     ax4.set_title("Change in heat content")
     ax4.set_xlabel("Time (years)")
     ax4.set_ylabel("Energy ($10^9 Jm^{-2}$)")
-    ax4.plot(time, (hc1_ml-hc1_ml[0]) / SV, color=cs['T'], label="Trop. ML")
-    ax4.plot(time, (hc2_ml-hc2_ml[0]) / SV, color=cs['ET'], label="E-Trop. ML")
-    ax4.plot(time, (hc1_th-hc1_th[0]) / SV, color=cs['T2'], label="Trop. Th")
-    ax4.plot(time, (hc2_th-hc2_th[0]) / SV, color=cs['ET2'], label="E-Trop. Th")
+    plot_series(ax4, 'dhc1_ml', d, color=cs['T'], label="Trop. ML")
+    plot_series(ax4, 'dhc2_ml', d, color=cs['ET'], label="E-Trop. ML")
+    plot_series(ax4, 'dhc1_th', d, color=cs['T2'], label="Trop. Th")
+    plot_series(ax4, 'dhc2_th', d, color=cs['ET2'], label="E-Trop. Th")
     ax4.legend(loc=2)
     
     fig.tight_layout(rect=[0,0.03,1,0.95])
 
     return fig
 
-def atmosphere(box1, box2, glob):
+def atmosphere(box1, box2, glob, d=None):
     """ Plot things to do with the atmosphere
                     
                     python plot.py atmos            """
 
-    time = glob['time'] / YEAR
-    
-    # Compute heat content
-    hc1 = HCA * box1['Ta'] 
-    hc2 = HCA * box2['Ta']
+    if d is None:
+        d = Derived(box1, box2, glob)
 
     fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, sharex='all')
     fig.suptitle("Atmosphere")
 
     ax1.set_title("Atmospheric Temperatures")
     ax1.set_ylabel("Temperature (K)")
-    ax1.plot(time, box1['Ta'], color=cs['T'], label="Trop.")
-    ax1.plot(time, box2['Ta'], color=cs['ET'], label="E-Trop.")
-    ax1.plot(time, 0.5*(box1['Ta']+box2['Ta']), color=cs['av'], label="Av.")
+    plot_series(ax1, 'box1.Ta', d, color=cs['T'], label="Trop.")
+    plot_series(ax1, 'box2.Ta', d, color=cs['ET'], label="E-Trop.")
+    plot_series(ax1, 'Ta_av', d, color=cs['av'], label="Av.")
     ax1.legend(loc=1)
 
     ax2.set_title("Carbon dioxide")
     ax2.set_xlabel("Time (years)")
     ax2.set_ylabel("Concentration (ppm)")
-    ax2.plot(time, glob['CO2'], cs['x'])
+    plot_series(ax2, 'CO2', d, cs['x'])
 
     ax3.set_title("Heat transport")
     ax3.set_xlabel("Time (years)")
     ax3.set_ylabel("Power ($10^{15}W$)")
-    ax3.plot(time, (glob['Fa'] * np.pi*RADIUS**2) / PW, color=cs['x'])
+    plot_series(ax3, 'Fa_PW', d, color=cs['x'])
 
     ax4.set_title("Change in heat content")
     ax4.set_xlabel("Time (years)")
     ax4.set_ylabel("Energy ($10^9 Jm^{-2}$)")
-    ax4.plot(time, (hc1-hc1[0]) / SV, color=cs['T'], label="Trop.")
-    ax4.plot(time, (hc2-hc2[0]) / SV, color=cs['ET'], label="E-Trop.")
+    plot_series(ax4, 'dhc1_at', d, color=cs['T'], label="Trop.")
+    plot_series(ax4, 'dhc2_at', d, color=cs['ET'], label="E-Trop.")
     ax4.legend(loc=4)
     
     fig.tight_layout(rect=[0,0.03,1,0.95])
@@ -436,25 +629,77 @@ def atmosphere(box1, box2, glob):
 def all_figs(box1, box2, glob):
     """ Just run all plotting functions and return all the figures """
     
+    # Derived quantities shared between the figures
+    d = Derived(box1, box2, glob)
+
     # Initialise list to hold figures
     fig_list = []
 
-    fig_list.append( temperatures(box1, box2, glob) )
-    fig_list.append( transport(box1, box2, glob) )
-    fig_list.append( hydro(box1, box2, glob) )
-    fig_list.append( fluxes(box1, box2, glob) )
-    fig_list.append( energy(box1, box2, glob) )
-    fig_list.append( carbon_dioxide(box1, box2, glob) )
-    fig_list.append( ocean(box1, box2, glob) )
-    fig_list.append( atmosphere(box1, box2, glob) )
+    fig_list.append( temperatures(box1, box2, glob, d) )
+    fig_list.append( transport(box1, box2, glob, d) )
+    fig_list.append( hydro(box1, box2, glob, d) )
+    fig_list.append( fluxes(box1, box2, glob, d) )
+    fig_list.append( energy(box1, box2, glob, d) )
+    fig_list.append( carbon_dioxide(box1, box2, glob, d) )
+    fig_list.append( ocean(box1, box2, glob, d) )
+    fig_list.append( atmosphere(box1, box2, glob, d) )
 
     return fig_list
     
-def save_figs(fig_list, loc):    
+def save_figs(fig_list, loc, filename="figures.pdf"):    
     """ Save all figures to one pdf.
-        Assumes 'loc' exists, which should always be the case """
+        Assumes 'loc' exists, which should always be the case.
+
+        If the figures come from plot_figs, each page is also kept in the
+        figure cache (see below), and the pdf is joined from the cached
+        pages, so each figure is only drawn once. The pdf isn't saved again
+        if none of its pages have changed, and pages plot_figs found
+        unchanged in the cache are copied from it rather than drawn again. """
     
-    save_pdf = mpl_pdf.PdfPages(loc+"figures.pdf")
+    record = loc + figure_cache + filename + ".pages"
+
+    if fig_list and all(isinstance(fig, _CachedPage) or _cache_name(fig) for fig in fig_list):
+        paths = [_cache_page(fig, loc) for fig in fig_list]
+        names = "\n".join(os.path.basename(path) for path in paths) + "\n"
+
+        # Nothing has changed since the pdf was last saved
+        if os.path.exists(loc+filename) and os.path.exists(record) and open(record).read() == names:
+            return
+
+        # The pages are joined, so each figure is only drawn once, into the
+        # cache. If they can't be read, the cached ones are plotted again
+        # and the pdf saved as usual.
+        try:
+            _join_pages(paths, loc+filename)
+        except (ValueError, KeyError, IndexError, AttributeError):
+            plotted = [fig.plot() if isinstance(fig, _CachedPage) else fig for fig in fig_list]
+            _save_pdf(plotted, loc+filename)
+
+            # Replace the pages which couldn't be read
+            for fig, page in zip(plotted, fig_list):
+                if isinstance(page, _CachedPage):
+                    os.remove(page.path)
+                    fig.set_gid(figure_cache + _cache_name(page))
+                    _cache_page(fig, loc)
+                    plt.close(fig)
+
+        with open(record, 'w') as f:
+            f.write(names)
+        return
+
+    # The pdf no longer has the pages in the record
+    if os.path.exists(record):
+        os.remove(record)
+
+    _save_pdf(fig_list, loc+filename)
+
+    return
+
+
+def _save_pdf(fig_list, path):
+    """ Save the figures to one pdf, with matplotlib """
+
+    save_pdf = mpl_pdf.PdfPages(path)
         
     for fig in fig_list:
         save_pdf.savefig(fig)
@@ -463,14 +708,659 @@ def save_figs(fig_list, loc):
 
     return
 
+####################
+##  Figure cache  ##
+####################
+
+# Each page of figures.pdf is also saved on its own to this directory, in the
+# same directory as the data, named by the figure and a hash of everything it
+# depends on: the data it plots, the code plotting it and the plotting
+# parameters. Saving the figures again only plots those whose hash has
+# changed, and the pdf is only saved again if a page has changed, so
+# re-plotting runs which haven't changed (python plot.py batch sweep/*/ all)
+# is almost free.
+figure_cache = ".figures/"
+
+# rcParams which don't change what's saved in the pdf
+_cache_ignored_rc = ('backend', 'backend_fallback', 'interactive')
+
+def _code_hash():
+    """ Hash of the code and constants shared between all of the figures """
+
+    h = hashlib.sha1()
+    h.update(mpl.__version__)
+    h.update(inspect.getsource(Derived))
+    h.update(inspect.getsource(plot_series))
+    for key in sorted(series):
+        h.update(key + inspect.getsource(series[key]))
+    h.update(repr(sorted(cs.items())))
+    h.update(repr(sorted( (name, value) for name, value in vars(constants).items()
+                          if isinstance(value, (int, float)) )))
+
+    return h.hexdigest()
+
+
+def figure_hash(key, box1, box2, glob, code=None):
+    """ Hash of the figure given by 'key' plotted from this data, with the
+        present code and rcParams. 'code' is _code_hash(), if it's known. """
+
+    h = hashlib.sha1()
+    h.update(code or _code_hash())
+    h.update(inspect.getsource(plot_dict[key]))
+    h.update(repr(sorted( (name, value) for name, value in plt.rcParams.items()
+                          if name not in _cache_ignored_rc )))
+
+    data = {'box1': box1, 'box2': box2, 'glob': glob}
+    for name in ('glob.time',) + figure_vars[key]:
+        column = np.ascontiguousarray(data[name.split('.')[0]][name.split('.')[1]])
+        h.update(name + str(column.dtype) + str(column.shape))
+        h.update(column)
+
+    return h.hexdigest()
+
+
+class _CachedPage(object):
+    """ Stands in for a figure from plot_figs whose page is in the figure
+        cache, unchanged, so it hasn't been plotted """
+
+    def __init__(self, path, key, box1, box2, glob, d):
+        self.path = path
+        self.key = key
+        self.data = (box1, box2, glob, d)
+
+    def plot(self):
+        """ Plot the figure after all """
+        return plot_dict[self.key](*self.data)
+
+
+def plot_figs(box1, box2, glob, keys, loc=None):
+    """ The figures given by 'keys', sharing the derived series between them,
+        to be saved by save_figs. If 'loc' is given, figures already in its
+        figure cache, unchanged, aren't plotted: a _CachedPage is returned in
+        place of the figure. """
+
+    d = Derived(box1, box2, glob)
+    code = _code_hash()
+
+    fig_list = []
+    for key in keys:
+        name = "%s-%s.pdf" %(key, figure_hash(key, box1, box2, glob, code))
+        if loc is not None and os.path.exists(loc+figure_cache+name):
+            fig_list.append( _CachedPage(loc+figure_cache+name, key, box1, box2, glob, d) )
+        else:
+            fig = plot_dict[key](box1, box2, glob, d)
+            fig.set_gid(figure_cache+name)
+            fig_list.append(fig)
+
+    return fig_list
+
+
+def _cache_name(fig):
+    """ Name of the cached page of a figure from plot_figs, otherwise None """
+
+    if isinstance(fig, _CachedPage):
+        return os.path.basename(fig.path)
+    gid = fig.get_gid()
+    if gid is not None and gid.startswith(figure_cache):
+        return gid[len(figure_cache):]
+    return None
+
+
+def _cache_page(fig, loc):
+    """ Path of the page of 'fig' in the figure cache in loc, saving it there
+        (and removing any older page of the same figure) if it isn't yet """
+
+    if isinstance(fig, _CachedPage):
+        return fig.path
+
+    name = _cache_name(fig)
+    path = loc + figure_cache + name
+    if not os.path.exists(path):
+        if not os.path.isdir(loc+figure_cache):
+            os.makedirs(loc+figure_cache)
+        key = name.rsplit('-', 1)[0]
+        for old in os.listdir(loc+figure_cache):
+            if old.rsplit('-', 1)[0] == key:
+                os.remove(loc+figure_cache+old)
+
+        # Saved under another name first, so an interrupted save isn't reused
+        fig.savefig(path+".tmp", format='pdf')
+        os.rename(path+".tmp", path)
+
+    return path
+
+
+def _pdf_objects(path):
+    """ The objects of a one-page pdf saved by matplotlib, as a dictionary of
+        number: text of the object, with the numbers of its Page and Pages
+        objects and the objects which aren't part of the page. Raises
+        ValueError if the pdf isn't laid out as expected. """
+
+    with open(path, 'rb') as f:
+        objects, root, info = _pdf_parse(f.read(), path)
+
+    pages, kids = _pdf_kids(objects, root, path)
+    if len(kids) != 1:
+        raise ValueError("%s has more than one page" %path)
+
+    excluded = [root, pages] + ([info] if info is not None else [])
+    return objects, kids[0], pages, excluded
+
+
+def _pdf_parse(pdf, path):
+    """ The objects of the pdf 'pdf' (the contents of 'path'), as a dictionary
+        of number: text of the object, with the numbers of its Catalog and Info
+        (or None) objects. Raises ValueError unless it has a single
+        cross-reference table, without any updates to the file, giving the
+        offset of each of its objects. """
+
+    # Cross-reference table: offset of each object in the file
+    xref = int(pdf[pdf.rindex('startxref'):].split()[1])
+    table = pdf[xref:pdf.index('trailer', xref)].split()
+    if table[0] != 'xref' or len(table) != 3 + 3*int(table[2]):
+        raise ValueError("Unexpected cross-reference table in %s" %path)
+    first = int(table[1])
+    offsets = dict( (first + k, int(table[3+3*k])) for k in range(int(table[2]))
+                    if table[5+3*k] == 'n' )
+
+    # Each object runs up to the start of the next one
+    ends = sorted(offsets.values()) + [xref]
+    objects = dict( (number, pdf[start:ends[ends.index(start)+1]].rstrip())
+                    for number, start in offsets.items() )
+
+    for number, obj in objects.items():
+        if not re.match(r'%d\s+0\s+obj\b' %number, obj) or not obj.endswith('endobj'):
+            raise ValueError("Unexpected object %d in %s" %(number, path))
+
+    trailer = pdf[pdf.index('trailer', xref):]
+    if '/Prev' in trailer:
+        raise ValueError("%s has been updated" %path)
+    root = int(re.search(r'/Root\s+(\d+)\s+0\s+R', trailer).group(1))
+    info = re.search(r'/Info\s+(\d+)\s+0\s+R', trailer)
+
+    return objects, root, int(info.group(1)) if info else None
+
+
+def _pdf_kids(objects, root, path):
+    """ The number of the Pages object of a pdf parsed by _pdf_parse, and of
+        each of its pages """
+
+    pages = int(re.search(r'/Pages\s+(\d+)\s+0\s+R', objects[root]).group(1))
+    kids = re.findall(r'(\d+)\s+0\s+R', re.search(r'/Kids\s*\[([^]]*)\]', objects[pages]).group(1))
+
+    return pages, [int(kid) for kid in kids]
+
+
+def _pdf_head(obj):
+    """ The text of a pdf object before its stream, if it has one """
+    stream = re.search(r'>>\s*stream\r?\n', obj)
+    return obj[:stream.end()] if stream else obj
+
+
+def _join_pages(paths, filename):
+    """ Join one-page pdfs saved by matplotlib into a single pdf, renumbering
+        the objects of each so that the pages share one Pages object """
+
+    out = ["%PDF-1.4\n%\xac\xdc \xab\xba\n"]
+    offsets = [0, None, None]       # objects 1 and 2 are the Catalog and Pages
+    size = len(out[0])
+    kids = []
+
+    for path in paths:
+        objects, page, pages, excluded = _pdf_objects(path)
+
+        # New numbers, following on from the last page: the page's Parent is
+        # the new Pages object
+        numbers = {pages: 2}
+        for number in sorted(objects):
+            if number not in excluded:
+                numbers[number] = len(offsets) + len(numbers) - 1
+        kids.append(numbers[page])
+
+        renumber = lambda match: "%d%s" %(numbers[int(match.group(1))], match.group(2))
+        for number in sorted(objects, key=numbers.get):
+            if number in excluded:
+                continue
+            # References are only rewritten outside of the streams
+            head = _pdf_head(objects[number])
+            offsets.append(size)
+            out.append(re.sub(r'(\d+)(\s+0\s+(?:R|obj))\b', renumber, head)
+                       + objects[number][len(head):] + "\n")
+            size += len(out[-1])
+
+    offsets[1] = size
+    out.append("1 0 obj\n<< /Pages 2 0 R /Type /Catalog >>\nendobj\n")
+    offsets[2] = size + len(out[-1])
+    out.append("2 0 obj\n<< /Count %d /Kids [ %s ] /Type /Pages >>\nendobj\n"
+               %(len(kids), " ".join("%d 0 R" %kid for kid in kids)))
+    size = offsets[2] + len(out[-1])
+
+    out.append("xref\n0 %d\n0000000000 65535 f \n" %len(offsets))
+    out.extend("%010d 00000 n \n" %offset for offset in offsets[1:])
+    out.append("trailer\n<< /Root 1 0 R /Size %d >>\nstartxref\n%d\n%%%%EOF\n" %(len(offsets), size))
+
+    # Check that the pdf can be read back, with every page and reference
+    # where it should be, before it's written
+    pdf = "".join(out)
+    objects, root, info = _pdf_parse(pdf, filename)
+    pages, joined = _pdf_kids(objects, root, filename)
+    count = re.search(r'/Count\s+(\d+)', objects[pages])
+    if joined != kids or len(kids) != len(paths) or not count or int(count.group(1)) != len(paths) \
+            or not all(re.search(r'/Type\s*/Page\b', objects[kid]) for kid in kids):
+        raise ValueError("Joined pages of %s don't match" %filename)
+    for number, obj in objects.items():
+        for ref in re.findall(r'(\d+)\s+0\s+R\b', _pdf_head(obj)):
+            if int(ref) not in objects:
+                raise ValueError("Object %d of %s refers to a missing object" %(number, filename))
+
+    with open(filename, 'wb') as f:
+        f.write(pdf)
+
+    return
+
+##################
+##  Watch mode  ##
+##################
+
+# Seconds between checks for new output while watching a simulation
+watch_interval = 2.
+
+class _Tail(object):
+    """ Follows a text file written by model.save, parsing only the rows
+        appended since the previous read. """
+
+    def __init__(self, path, ncols):
+        self.path = path
+        self.ncols = ncols
+        self.offset = 0     # bytes already parsed
+
+    def read(self):
+        """ Return an array of the complete rows added since the last call """
+        empty = np.zeros( (0, self.ncols) )
+        try:
+            f = open(self.path, 'rb')
+        except IOError: # simulation hasn't saved anything yet
+            return empty
+
+        # model.save rewrites the whole file each time, but the rows already
+        # written don't change. If the file is shorter than what we've already
+        # parsed it's in the middle of being rewritten, so try again later.
+        f.seek(0, 2)
+        if f.tell() < self.offset:
+            f.close()
+            return empty
+
+        f.seek(self.offset)
+        chunk = f.read()
+        f.close()
+
+        # Leave any partially written row for next time
+        end = chunk.rfind(b'\n') + 1
+        if end == 0:
+            return empty
+        self.offset += end
+
+        return np.fromstring(chunk[:end], sep=' ').reshape(-1, self.ncols)
+
+
+class _NpyTail(object):
+    """ Follows the binary state.npy written by model.save, reading only the
+        rows appended since the previous read. """
+
+    def __init__(self, path):
+        self.path = path
+        self.nrows = 0      # rows already read
+
+    def read(self):
+        """ Return an array of the complete rows added since the last call """
+        empty = np.zeros( (0, 21) )
+        try:
+            f = open(self.path, 'rb')
+        except IOError: # simulation hasn't saved anything yet
+            return empty
+
+        # As with the text files, the whole file is rewritten on each save,
+        # so give up until next time if the header can't be read yet.
+        try:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        except ValueError:
+            f.close()
+            return empty
+
+        # Only count rows that have been completely written
+        start = f.tell()
+        f.seek(0, 2)
+        row_bytes = shape[1] * dtype.itemsize
+        nrows = min(shape[0], (f.tell() - start) // row_bytes)
+        if nrows <= self.nrows:
+            f.close()
+            return empty
+
+        f.seek(start + self.nrows*row_bytes)
+        rows = np.fromfile(f, dtype=dtype, count=(nrows-self.nrows)*shape[1])
+        f.close()
+        self.nrows = nrows
+
+        return rows.reshape(-1, shape[1])
+
+
+class _Buffer(object):
+    """ Growable 1d array: appending costs (amortised) O(number of new values) """
+
+    def __init__(self, values):
+        self.n = len(values)
+        self.data = np.zeros( max(2*self.n, 1024) )
+        self.data[:self.n] = values
+
+    def extend(self, values):
+        if self.n + len(values) > len(self.data):
+            data = np.zeros( 2*(self.n + len(values)) )
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+        self.data[self.n:self.n+len(values)] = values
+        self.n += len(values)
+
+    def view(self):
+        return self.data[:self.n]
+
+
+def watch(loc, keys, interval=watch_interval):
+    """ Follow the output of a running simulation, extending the lines of the
+        figures given by 'keys' (see plot_dict) whenever model.save writes new rows.
+        Returns once all of the figures have been closed.
+
+                python plot.py control/ watch temps co2         """
+
+    if os.path.exists(loc+"prognostic.npz") or save_format == 'prognostic':
+        print "Watch mode needs save_format = 'txt' or 'npy'"
+        return
+
+    # Returns the new rows for box1, box2 and global data
+    if os.path.exists(loc+"state.npy") or save_format == 'npy':
+        tail = _NpyTail(loc+"state.npy")
+        read = lambda: np.hsplit(tail.read(), 3)
+    else:
+        tails = [_Tail(loc+"box1.out", 7), _Tail(loc+"box2.out", 7), _Tail(loc+"global.out", 7)]
+        read = lambda: [tail.read() for tail in tails]
+
+    pending = read()
+
+    def complete_rows():
+        """ Remove and return the rows which have been written to all three files """
+        nrows = min(len(rows) for rows in pending)
+        new = [rows[:nrows] for rows in pending]
+        pending[:] = [rows[nrows:] for rows in pending]
+        return new
+
+    # Wait for the first save
+    while min(len(rows) for rows in pending) == 0:
+        print "Waiting for output in '%s'..." %loc
+        plt.pause(interval)
+        pending = [np.vstack( (rows, new) ) for rows, new in zip(pending, read())]
+
+    # Draw the figures using everything that has been saved so far
+    arrs = complete_rows()
+    first = [arr[:1] for arr in arrs]
+    box1, box2, glob = as_data(*arrs)
+    d = Derived(box1, box2, glob)
+    fig_list = [plot_dict[key](box1, box2, glob, d) for key in keys]
+
+    # Hold the plotted data in growable buffers, shared by lines showing the same series
+    buffers = {'time': _Buffer(d['time'])}
+    for fig in fig_list:
+        for ax in fig.axes:
+            for line in ax.get_lines():
+                if line.get_gid() not in buffers:
+                    buffers[line.get_gid()] = _Buffer(line.get_ydata())
+
+    plt.show(block=False)
+
+    while plt.get_fignums():
+        plt.pause(interval)
+
+        pending = [np.vstack( (rows, new) ) for rows, new in zip(pending, read())]
+        new = complete_rows()
+        if len(new[0]) == 0:
+            continue
+
+        # Compute the new part of each series. The first row is included
+        # for the series which are measured relative to the start.
+        chunk = Derived(*as_data(*[np.vstack( (f, rows) ) for f, rows in zip(first, new)]))
+        for key in buffers:
+            buffers[key].extend( chunk[key][1:] )
+
+        time = buffers['time'].view()
+        time_new = time[-len(new[0]):]
+        for fig in fig_list:
+            for ax in fig.axes:
+                for line in ax.get_lines():
+                    y = buffers[line.get_gid()].view()
+                    line.set_data(time, y)
+
+                    # Extend the data limits with the new points only (ax.relim
+                    # would go through the whole history again)
+                    ax.dataLim.update_from_data_xy( np.column_stack( (time_new, y[-len(time_new):]) ),
+                                                    ignore=False )
+                ax.autoscale_view()
+            fig.canvas.draw_idle()
+
+    return
+
+
+##################
+##  Batch mode  ##
+##################
+
+# Number of runs loaded or plotted at once in batch mode
+batch_processes = multiprocessing.cpu_count()
+
+# Line styles telling apart the series on the same axes in overlay figures,
+# where the colours tell apart the runs
+overlay_styles = ['-', '--', ':', '-.']
+
+# Runs are only named in a legend if there are at most this many of them
+overlay_max_legend = 20
+
+def figure_variables(keys):
+    """ Saved variables used by the figures given by 'keys' (see figure_vars) """
+    variables = set()
+    for key in keys:
+        variables.update(figure_vars[key])
+    return variables
+
+
+def _load_run(args):
+    """ load_data for Pool.map, copying the (possibly memory-mapped) arrays
+        so that they can be sent back from the worker """
+    loc, years, variables = args
+    return tuple( dict( (key, np.array(value)) for key, value in data.items() )
+                  for data in load_data(loc, years, variables) )
+
+
+def _plot_run(args):
+    """ Load one run and save its figures to loc/figures.pdf, for Pool.map """
+    loc, keys, years = args
+
+    box1, box2, glob = load_data(loc, years, figure_variables(keys))
+    fig_list = plot_figs(box1, box2, glob, keys, loc)
+    save_figs(fig_list, loc)
+
+    for fig in fig_list:
+        if not isinstance(fig, _CachedPage):
+            plt.close(fig)
+
+    return loc
+
+
+def batch(locs, keys, years=None, processes=batch_processes):
+    """ Save the figures given by 'keys' for each of the runs in 'locs' to
+        loc/figures.pdf. The runs are loaded and plotted in parallel, and the
+        data of each run is loaded once and shared between its figures.
+
+                python plot.py batch co2_doubling/tau_*/ all        """
+
+    # No figures are shown, and windows can't be opened from the workers
+    plt.switch_backend('agg')
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for loc in pool.imap_unordered(_plot_run, [(loc, keys, years) for loc in locs]):
+            print "Saved %sfigures.pdf" %loc
+    finally:
+        pool.close()
+        pool.join()
+
+    return
+
+
+def overlay(locs, keys, years=None, processes=batch_processes):
+    """ Plot the runs in 'locs' on the same axes, one colour per run, and
+        return the figures given by 'keys'. The runs are loaded in parallel.
+
+                python plot.py batch overlay co2_doubling/tau_*/ co2 save   """
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        runs = pool.map(_load_run, [(loc, years, figure_variables(keys)) for loc in locs])
+    finally:
+        pool.close()
+        pool.join()
+
+    derived = [Derived(*run) for run in runs]
+    colours = plt.cm.viridis(np.linspace(0, 0.9, len(runs)))
+    names = [loc.rstrip('/') for loc in locs]
+
+    fig_list = []
+    for key in keys:
+        # Lay out the figure with the first run, then add the same series
+        # (identified by the gid of each line) from the other runs
+        box1, box2, glob = runs[0]
+        fig = plot_dict[key](box1, box2, glob, derived[0])
+        del fig.legends[:]
+
+        for ax in fig.axes:
+            if ax.get_legend() is not None:
+                ax.get_legend().remove()
+
+            lines = ax.get_lines()
+            for line, style in zip(lines, overlay_styles*len(lines)):
+                line.set_color(colours[0])
+                line.set_linestyle(style)
+                for d, colour in zip(derived[1:], colours[1:]):
+                    ax.plot(d['time'], d[line.get_gid()], color=colour, linestyle=style, gid=line.get_gid())
+
+            # Name the series where there is more than one
+            if len(lines) > 1:
+                ax.legend([Line2D([], [], color='k', linestyle=style) for line, style in zip(lines, overlay_styles*len(lines))],
+                          [line.get_label() for line in lines])
+
+            ax.relim()
+            ax.autoscale_view()
+
+        # Legend of the runs along the bottom, with room made for it
+        if len(runs) <= overlay_max_legend:
+            fig.legend(handles=[Line2D([], [], color=colour) for colour in colours], labels=names,
+                       loc='lower center', ncol=min(len(runs), 4))
+            fig.tight_layout(rect=[0, 0.01 + 0.03*np.ceil(len(runs)/4.), 1, 0.95])
+
+        fig_list.append(fig)
+
+    return fig_list
+
+
+###################
+##  Variability  ##
+###################
+
+def internal_variability(results):
+    """ Plot the power spectra, autocorrelations and lag regressions of a
+        simulation, as calculated by variability.py. The spectra are divided
+        by their integrals, so that variables in different units can be compared.
+
+                    python plot.py variability          """
+
+    fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2)
+    fig.suptitle("Internal variability, %d years" %round(results['nsamples'] * results['step'] / YEAR))
+
+    freq = results['freq'][1:]
+    lags = results['lags']
+    positive = lags >= 0
+
+    ax1.set_title("Power spectra (%d segments)" %results['nsegments'])
+    ax1.set_xlabel("Frequency (cycles/year)")
+    ax1.set_ylabel("Normalised power (years)")
+    for name, power in zip(results['variables'], results['power']):
+        ax1.loglog(freq, power[1:] / (np.sum(power) * freq[0]), label=name)
+    ax1.legend(loc='best', fontsize=6)
+
+    ax2.set_title("Autocorrelation")
+    ax2.set_xlabel("Lag (years)")
+    for name, autocorr in zip(results['variables'], results['autocorr']):
+        ax2.plot(lags[positive], autocorr, label=name)
+    ax2.axhline(np.exp(-1), color=cs['x'], linestyle=':')
+
+    ax3.set_title("Lag correlation (y following x)")
+    ax3.set_xlabel("Lag (years)")
+    for (x, y), correlation in zip(results['pairs'], results['correlation']):
+        ax3.plot(lags, correlation, label="x: %s, y: %s" %(x, y))
+    if len(results['pairs']):
+        ax3.legend(loc='best', fontsize=6)
+
+    ax4.set_title("Lag regression of y on x")
+    ax4.set_xlabel("Lag (years)")
+    ax4.set_ylabel("Units of y per unit of x")
+    for (x, y), regression in zip(results['pairs'], results['regression']):
+        ax4.plot(lags, regression)
+
+    for ax in (ax3, ax4):
+        ax.axvline(0, color=cs['x'], linestyle=':')
+
+    fig.tight_layout(rect=[0,0.03,1,0.95])
+
+    return fig
+
+
 ########################
 ##  Script execution  ##
 ########################
 
+# Dictionary with argv strings as keys and plotting funcs as values
+plot_dict = {
+            'temps': temperatures,
+            'transport': transport,
+            'hydro': hydro,
+            'flux': fluxes,
+            'energy': energy,
+            'co2': carbon_dioxide,
+            'ocean': ocean,
+            'atmos': atmosphere
+            }
+
+# Order of the figures in figures.pdf (as in all_figs)
+all_keys = ('temps', 'transport', 'hydro', 'flux', 'energy', 'co2', 'ocean', 'atmos')
+
+# Saved variables used by each figure, so that only those need to be loaded
+figure_vars = {
+            'temps': ('box1.Ta', 'box1.Ts', 'box1.To', 'box2.Ta', 'box2.Ts', 'box2.To'),
+            'transport': ('glob.Fa', 'glob.Fo', 'glob.Psia', 'glob.Psio', 'glob.MTspt'),
+            'hydro': ('box1.Feva', 'box1.MSE', 'box1.Ta', 'box1.Ts',
+                      'box2.Feva', 'box2.MSE', 'box2.Ta', 'box2.Ts', 'glob.MTspt'),
+            'flux': ('box1.Ft', 'box1.Fs', 'box1.Feva', 'box2.Ft', 'box2.Fs', 'box2.Feva'),
+            'energy': ('box1.Ta', 'box1.Ts', 'box1.To', 'box1.MSE',
+                       'box2.Ta', 'box2.Ts', 'box2.To', 'box2.MSE'),
+            'co2': ('box1.Ta', 'box1.Ts', 'box1.To', 'box2.Ta', 'box2.Ts', 'box2.To', 'glob.CO2'),
+            'ocean': ('box1.Ts', 'box1.To', 'box2.Ts', 'box2.To', 'glob.Fo'),
+            'atmos': ('box1.Ta', 'box2.Ta', 'glob.CO2', 'glob.Fa')
+            }
+
 def auto(box1, box2, glob):
     """ Called from main.py. Plots the simulation that's just run """
     
-    fig_list = all_figs(box1, box2, glob)
+    fig_list = plot_figs(box1, box2, glob, all_keys, save_loc)
 
     save_figs(fig_list, save_loc)
 
@@ -479,47 +1369,85 @@ def auto(box1, box2, glob):
 # If running as a command-line script
 if __name__ == '__main__':
     
-    # Create dictionary with argv strings as keys and plotting funcs as values
-    plot_dict = {
-                'temps': temperatures,
-                'transport': transport,
-                'hydro': hydro,
-                'flux': fluxes,
-                'energy': energy,
-                'co2': carbon_dioxide,
-                'ocean': ocean,
-                'atmos': atmosphere
-                }
-    
     # Check if save location specified as argv[1]
     if argv[1] not in plot_dict.keys() and \
-            argv[1] not in ('all', 'save'):
+            argv[1] not in ('all', 'save', 'watch', 'batch', 'overlay', 'variability') and not argv[1].startswith('years='):
         loc = argv[1]
         if loc[-1] != '/': loc = loc + '/'
     else:
         loc = ""
     
-    # Load data
-    box1, box2, glob = load_data(loc)
+    # Follow a simulation which is still running
+    if 'watch' in argv:
+        if 'all' in argv:
+            keys = all_keys
+        else:
+            keys = [key for key in all_keys if key in argv]
+        watch(loc, keys)
+        exit()
+
+    # Time window given as years=first:last, either of which can be left out
+    years = None
+    for arg in argv:
+        if arg.startswith('years='):
+            years = years_arg(arg)
+
+    # Spectra, autocorrelations and lag regressions, from loc/variability.npz
+    # if it's been saved by variability.py, otherwise calculated
+    if 'variability' in argv:
+        import variability
+        if years is None and os.path.exists(loc + variability.results_file):
+            results = np.load(loc + variability.results_file)
+        else:
+            results = variability.analyse(loc, years)
+        fig = internal_variability(results)
+        if 'save' in argv:
+            save_figs([fig], loc, "variability.pdf")
+        plt.show()
+        exit()
+
+    # Plot many runs: every argument which isn't a keyword is a directory
+    if 'batch' in argv:
+        keywords = plot_dict.keys() + ['all', 'save', 'batch', 'overlay']
+        locs = [arg if arg.endswith('/') else arg+'/' for arg in argv[1:]
+                    if arg not in keywords and not arg.startswith('years=')]
+        if 'all' in argv:
+            keys = all_keys
+        else:
+            keys = [key for key in all_keys if key in argv]
+
+        if 'overlay' in argv:
+            fig_list = overlay(locs, keys, years)
+            if 'save' in argv:
+                save_figs(fig_list, "", "overlay.pdf")
+            plt.show()
+        else:
+            batch(locs, keys, years)
+        exit()
+
+    # Load data, just what's needed for the figures being plotted
+    if 'all' in argv:
+        variables = None
+    else:
+        variables = figure_variables([key for key in plot_dict.keys() if key in argv])
+
+    try:
+        box1, box2, glob = load_data(loc, years, variables)
+    except ValueError as error:
+        exit(str(error))
     
     # Plot figures
     if 'all' in argv:
-        fig_list = all_figs(box1, box2, glob)
-    
+        keys = all_keys
     else:
-        fig_list = []
-        
-        # Plot according to argument variables
-        for key in plot_dict.keys():
-            if key in argv:
-            
-                # Add figure to list
-                fig_list.append( plot_dict[key](box1, box2, glob) )
+        keys = [key for key in plot_dict.keys() if key in argv]
 
+    # If the figures are only being saved (they can't be shown with this
+    # backend), those saved before which haven't changed aren't plotted again
+    shown = mpl.get_backend().lower() not in mpl.rcsetup.non_interactive_bk
+    fig_list = plot_figs(box1, box2, glob, keys, loc if 'save' in argv and not shown else None)
     
     if 'save' in argv:
         save_figs(fig_list, loc)
 
     plt.show()
-
-
@@ -0,0 +1,404 @@
+import os
+import re
+import sys
+import json
+import glob
+import hashlib
+import tokenize
+import StringIO
+import threading
+import subprocess
+import multiprocessing
+import Queue
+import BaseHTTPServer
+import SocketServer
+
+# Local server which runs simulations for other programs (e.g. notebooks),
+# so that they don't have to edit params.py or run main.py themselves.
+#
+# A simulation is requested by POSTing a JSON object of the values of any of
+# the parameters in params.py and constants.py that should differ from those
+# files, e.g. {"nyr": 100, "CO2_increase": "exp", "KEFF": 6e9}. Each
+# simulation runs main.py in its own directory, jobs_dir/<id>/, with copies
+# of params.py and constants.py containing those values, and saves its
+# output to jobs_dir/<id>/output/. At most max_workers simulations run at
+# once, and the rest wait in a queue.
+#
+# The id depends only on the values requested and the model code, so a
+# request for a simulation which is already queued, running or finished
+# (even before the server was restarted) is given that simulation instead
+# of starting another one.
+#
+#     python server.py [port]
+#
+#     POST /jobs                      request a simulation, returns its status
+#     GET  /jobs                      status of all simulations
+#     GET  /jobs/<id>                 status of one simulation
+#     GET  /jobs/<id>/log             output of main.py, streamed until it finishes
+#     GET  /jobs/<id>/files/<name>    a file saved by the simulation
+#
+# Only connections from this machine are accepted.
+
+# ---------- #
+#  Settings  #
+# ---------- #
+host = "127.0.0.1"
+port = 8765
+
+# Number of simulations run at once
+max_workers = multiprocessing.cpu_count()
+
+# Directory the simulations are run in
+jobs_dir = "jobs/"
+
+# Directory of the model code
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# Files which can be given different values, and the parameters in them
+CONFIG_FILES = ("params.py", "constants.py")
+
+# Parameters which can't be set (all output goes to jobs_dir/<id>/output/)
+FIXED = ('save_loc',)
+
+
+def parameters():
+    """ Names of the parameters set in each of CONFIG_FILES """
+
+    names = {}
+    for fname in CONFIG_FILES:
+        source = open(os.path.join(REPO, fname)).read()
+        names[fname] = set(re.findall(r"^([A-Za-z_]\w*)\s*=", source, re.M)) - set(FIXED)
+
+    return names
+
+
+def code_version():
+    """ Hash of the model code, so that simulations aren't reused after it changes """
+
+    sha = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(REPO, "*.py"))):
+        sha.update(os.path.basename(path))
+        sha.update(open(path, 'rb').read())
+
+    return sha.hexdigest()
+
+
+def validate(config):
+    """ Check a requested configuration, raising ValueError if it isn't a
+        dictionary of parameters to simple values (numbers, strings, True/False) """
+
+    if not isinstance(config, dict):
+        raise ValueError("Expected a JSON object of parameter values")
+
+    known = set.union(*parameters().values())
+    for name, value in config.items():
+        if name not in known:
+            raise ValueError("Unknown parameter '%s'" %name)
+        if not isinstance(value, (bool, int, long, float, basestring)):
+            raise ValueError("Value of '%s' must be a number, string or true/false" %name)
+
+    return
+
+
+def _assignments(source):
+    """ Lines (first, last) of the first top-level assignment to each name in
+        'source', including any continuation lines """
+
+    spans = {}
+    statement = []
+    for kind, text, start, end, line in tokenize.generate_tokens(StringIO.StringIO(source).readline):
+        if kind in (tokenize.COMMENT, tokenize.NL) and not statement:
+            continue
+        statement.append( (kind, text, start) )
+        if kind in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            if len(statement) > 2 and statement[0][0] == tokenize.NAME and statement[0][2][1] == 0 \
+                    and statement[1][1] == '=' and statement[0][1] not in spans:
+                spans[statement[0][1]] = (statement[0][2][0], end[0])
+            statement = []
+
+    return spans
+
+
+def configured(fname, config):
+    """ Source of 'fname' with the values in 'config' replacing those in the file """
+
+    source = open(os.path.join(REPO, fname)).read()
+    names = parameters()[fname]
+
+    lines = {}
+    for name, value in config.items():
+        if name in names:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            lines[name] = "%s = %r" %(name, value)
+
+    if fname == "params.py":
+        lines['save_loc'] = 'save_loc = "output/"'
+
+    # Whole statements are replaced, from the last up, as some run over more than one line
+    source = source.splitlines()
+    spans = _assignments("\n".join(source) + "\n")
+    for name in sorted(lines, key=lambda name: spans[name][0], reverse=True):
+        first, last = spans[name]
+        source[first-1:last] = [lines[name]]
+
+    return "\n".join(source) + "\n"
+
+
+class Job(object):
+    """ One simulation, with the output of main.py as it runs """
+
+    def __init__(self, job_id, config):
+        self.id = job_id
+        self.config = config
+        self.dir = os.path.abspath(os.path.join(jobs_dir, job_id)) + '/'
+        self.status = 'queued'
+        self.returncode = None
+        self.log = []
+
+        # Notified whenever there's new output or the status changes
+        self.changed = threading.Condition()
+
+    def info(self):
+        """ Status of the job, as a dictionary for JSON """
+
+        output = self.dir + "output/"
+        files = sorted(name for name in os.listdir(output) if os.path.isfile(output + name)) \
+            if os.path.isdir(output) else []
+
+        return {'id': self.id, 'config': self.config, 'status': self.status,
+                'returncode': self.returncode, 'progress': self.log[-1] if self.log else None,
+                'output': output, 'files': files}
+
+    def add_line(self, line):
+        with self.changed:
+            self.log.append(line)
+            self.changed.notify_all()
+
+    def set_status(self, status, returncode=None):
+        with self.changed:
+            self.status = status
+            self.returncode = returncode
+            self.changed.notify_all()
+
+    def done(self):
+        return self.status in ('finished', 'failed')
+
+    def load_finished(self):
+        """ Pick up a simulation finished by an earlier server. Returns whether there was one. """
+
+        try:
+            result = json.load(open(self.dir + "result.json"))
+        except (IOError, ValueError):
+            return False
+        if result['returncode'] != 0:
+            return False
+
+        self.log = open(self.dir + "log.txt").read().splitlines()
+        self.set_status('finished', 0)
+
+        return True
+
+
+class Scheduler(object):
+    """ Runs jobs on a fixed number of worker threads, each running one
+        simulation at a time in a separate process """
+
+    def __init__(self, workers=max_workers):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.version = code_version()
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, config):
+        """ Queue a simulation with the values in 'config', unless the same one
+            has already been requested. Returns (job, whether it was reused). """
+
+        validate(config)
+
+        key = json.dumps( [self.version, config], sort_keys=True )
+        job_id = hashlib.sha1(key).hexdigest()[:12]
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.status != 'failed':
+                return job, True
+
+            job = Job(job_id, config)
+            self.jobs[job_id] = job
+            if job.load_finished():
+                return job, True
+
+        self.queue.put(job)
+
+        return job, False
+
+    def get(self, job_id):
+        """ The job with id 'job_id', or None """
+
+        with self.lock:
+            if job_id not in self.jobs and re.match(r"^[0-9a-f]+$", job_id):
+                # Finished before the server was restarted?
+                job = Job(job_id, None)
+                if job.load_finished():
+                    job.config = json.load(open(job.dir + "result.json"))['config']
+                    self.jobs[job_id] = job
+            return self.jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                job.add_line("Error running simulation: %s" %e)
+                job.set_status('failed')
+
+    def _run(self, job):
+        """ Run main.py for 'job' in its own directory """
+
+        if not os.path.exists(job.dir):
+            os.makedirs(job.dir)
+        for fname in CONFIG_FILES:
+            f = open(job.dir + fname, 'w')
+            f.write( configured(fname, job.config) )
+            f.close()
+
+        # The configured params.py and constants.py in the job's directory
+        # are imported instead of those in REPO
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join( [REPO] + filter(None, [env.get('PYTHONPATH')]) )
+        env['MPLBACKEND'] = 'Agg'
+        command = [sys.executable, '-u', '-c', "execfile(%r)" %os.path.join(REPO, "main.py")]
+
+        job.set_status('running')
+        log = open(job.dir + "log.txt", 'w')
+        process = subprocess.Popen(command, cwd=job.dir, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in iter(process.stdout.readline, ''):
+            log.write(line)
+            log.flush()
+            job.add_line(line.rstrip('\n'))
+        returncode = process.wait()
+        log.close()
+
+        json.dump({'config': job.config, 'returncode': returncode}, open(job.dir + "result.json", 'w'))
+        job.set_status('finished' if returncode == 0 else 'failed', returncode)
+
+        return
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ The HTTP interface to self.server.scheduler (see the top of this file) """
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, indent=1, sort_keys=True) + "\n"
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parts(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def do_POST(self):
+        if self.parts() != ['jobs']:
+            return self.send_json(404, {'error': "Not found"})
+
+        try:
+            body = self.rfile.read( int(self.headers.getheader('Content-Length', 0)) )
+            job, reused = self.server.scheduler.submit( json.loads(body) )
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+
+        info = job.info()
+        info['reused'] = reused
+        self.send_json(200 if reused else 202, info)
+
+    def do_GET(self):
+        parts = self.parts()
+        scheduler = self.server.scheduler
+
+        if parts in ([], ['jobs']):
+            with scheduler.lock:
+                jobs = scheduler.jobs.values()
+            return self.send_json(200, [job.info() for job in jobs])
+
+        if len(parts) < 2 or parts[0] != 'jobs':
+            return self.send_json(404, {'error': "Not found"})
+        job = scheduler.get(parts[1])
+        if job is None:
+            return self.send_json(404, {'error': "No job '%s'" %parts[1]})
+
+        if len(parts) == 2:
+            self.send_json(200, job.info())
+
+        elif parts[2:] == ['log']:
+            self.stream_log(job)
+
+        elif len(parts) == 4 and parts[2] == 'files':
+            output = job.dir + "output/"
+            if not os.path.isdir(output) or parts[3] not in os.listdir(output) \
+                    or not os.path.isfile(output + parts[3]):
+                return self.send_json(404, {'error': "No file '%s'" %parts[3]})
+            data = open(output + parts[3], 'rb').read()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        else:
+            self.send_json(404, {'error': "Not found"})
+
+    def stream_log(self, job):
+        """ Send the output of the job line by line, as it's written, until
+            the job is done (the end of the response is the end of the job) """
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+
+        sent = 0
+        while True:
+            with job.changed:
+                while sent == len(job.log) and not job.done():
+                    job.changed.wait(1.)
+                lines = job.log[sent:]
+                done = job.done()
+            sent += len(lines)
+
+            for line in lines:
+                self.wfile.write(line + "\n")
+            self.wfile.flush()
+
+            if done and sent == len(job.log):
+                self.wfile.write("[%s]\n" %job.status)
+                return
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Handles each request in its own thread, so that streaming a log
+        doesn't hold up other requests """
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+
+    server = Server( (host, port), Handler )
+    server.scheduler = Scheduler()
+
+    print "Running simulations on http://%s:%d/jobs, %d at a time" %(host, port, max_workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,428 @@
+import os
+import itertools
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from sys import argv
+
+from constants import *
+from params import *
+import model
+import nbox
+import hooks
+import plot
+from writer import write_array
+
+# Internal variability of long stochastic simulations: power spectra (by
+# Welch's method), autocorrelations and lag regressions of some of the box
+# and global variables. The rows of the simulation are gone through a chunk
+# at a time, so the memory used doesn't depend on how long it is.
+#
+# Of saved output, state.npy or nbox.npy (memory-mapped), prognostic.npz
+# (calculated a chunk at a time) or the text files:
+#     python variability.py [loc] [years=first:last]
+# saves loc/variability.npz, which is plotted by
+#     python plot.py [loc] variability [save]
+#
+# During a simulation, without saving the whole of it, with hooks_module in
+# params.py (see hooks.py) set to a module containing
+#     import variability
+#     variability.record()
+# saves save_loc/variability.npz at the end of the simulation.
+#
+# The results are a dictionary of arrays:
+#     variables, pairs    - names of the variables, and (x, y) pairs, analysed
+#     freq, power         - frequencies (cycles/year) and the power spectral
+#                           density of each variable (units^2 year)
+#     lags                - lags (years), from -max_lag_years to max_lag_years
+#     autocorr            - autocorrelation of each variable at lags >= 0
+#     regression          - regression of y(t + lag) on x(t) for each pair, so
+#                           positive lags are y following x
+#     correlation         - correlation of y(t + lag) with x(t) for each pair
+#     mean, variance      - of each variable
+#     nsamples, nsegments - number of rows, and of segments in the spectra
+#     step                - time between rows (s)
+
+# ---------- #
+#  Settings  #
+# ---------- #
+# Variables analysed, by the names of the columns of the state array (see
+# nbox.state_columns). For the N-box model, NBOX_VARIABLES in every box or edge.
+VARIABLES = ('box1.Ts', 'box2.Ts', 'box1.To', 'box2.To', 'glob.Fa', 'glob.Fo')
+NBOX_VARIABLES = ('Ts', 'To', 'Fa', 'Fo')
+
+# (x, y) pairs of variables for the lag regressions of y on x
+PAIRS = (('box1.Ts', 'box2.Ts'), ('glob.Fa', 'box2.Ts'), ('glob.Fo', 'box2.Ts'))
+
+# Length of the segments the spectra are averaged over (years), which overlap
+# by half. Longer segments resolve lower frequencies, but are noisier.
+segment_years = 100.
+
+# Trend removed from each segment: 'constant' (just the mean) or 'linear'
+detrend = 'linear'
+
+# Longest lag of the autocorrelations and regressions (years)
+max_lag_years = 20.
+
+# Rows gone through at a time
+chunk_rows = 100000
+
+# File the results are saved to, in the output directory
+results_file = "variability.npz"
+
+
+def default_variables(columns):
+    """ The VARIABLES (NBOX_VARIABLES for the N-box model) and PAIRS which
+        are columns of the state array """
+
+    if 'glob.time' in columns:
+        variables = [name for name in VARIABLES if name in columns]
+    else:
+        variables = [name for name in columns if name.split('_')[0] in NBOX_VARIABLES]
+    pairs = [(x, y) for x, y in PAIRS if x in columns and y in columns]
+
+    return variables, pairs
+
+
+class Variability(object):
+    """ Spectra, autocorrelations and lag regressions of some of the columns
+        of a state array, from consecutive chunks of its rows passed to add().
+
+        columns     - names of the columns of the state array
+        step        - time between rows (s)
+        variables   - names of the columns analysed
+        pairs       - (x, y) names of the columns for the lag regressions
+
+        Only the rows of the last segment and of the longest lag are kept, and
+        sums over the rest. """
+
+    def __init__(self, columns, step, variables, pairs, segment=segment_years,
+                 max_lag=max_lag_years, detrend=detrend):
+
+        if detrend not in ('constant', 'linear'):
+            raise ValueError("detrend must be 'constant' or 'linear'")
+
+        self.variables = list(variables)
+        self.pairs = [tuple(pair) for pair in pairs]
+        self.cols = [columns.index(name) for name in self.variables]
+        self.step = float(step)
+        self.detrend = detrend
+
+        nvar = len(self.variables)
+        self.nseg = max(2, int(round( segment*YEAR / self.step )))
+        self.max_lag = max(0, int(round( max_lag*YEAR / self.step )))
+
+        # Values are stored relative to the first row, so that the sums of
+        # products don't lose the variability to the size of the values
+        self.offset = None
+        self.n = 0
+        self.sums = np.zeros(nvar)
+        self.squares = np.zeros(nvar)
+
+        # Rows which aren't yet in a complete segment, and the sum of the
+        # periodograms of the segments so far
+        self.pending = np.zeros( (0, nvar) )
+        self.nsegments = 0
+        self.window = np.hanning(self.nseg)
+        self.periodograms = np.zeros( (self.nseg//2 + 1, nvar) )
+
+        # The first and last max_lag rows, and the sums of the products of the
+        # variables in each of 'products' at lags -max_lag, ..., max_lag: each
+        # variable with itself, then each of the pairs
+        self.head = np.zeros( (0, nvar) )
+        self.history = np.zeros( (self.max_lag, nvar) )
+        self.products = [(i, i) for i in range(nvar)] \
+                            + [(self.variables.index(x), self.variables.index(y)) for x, y in self.pairs]
+        self.lagged = np.zeros( (len(self.products), 2*self.max_lag + 1) )
+
+    def add(self, rows):
+        """ Add the next rows of the state array (at most chunk_rows at a time) """
+
+        rows = np.asarray(rows)
+        for start in range(0, len(rows), chunk_rows):
+            values = np.array(rows[start:start+chunk_rows, self.cols], dtype=float)
+
+            if self.offset is None:
+                self.offset = values[0].copy()
+            values -= self.offset
+
+            self.n += len(values)
+            self.sums += values.sum(axis=0)
+            self.squares += (values**2).sum(axis=0)
+            if len(self.head) < self.max_lag:
+                self.head = np.concatenate( (self.head, values[:self.max_lag - len(self.head)]) )
+            self._add_segments(values)
+            self._add_products(values)
+
+        return
+
+    def _add_segments(self, values):
+        """ Add the periodograms of the segments completed by 'values' """
+
+        pending = np.concatenate( (self.pending, values) )
+        hop = self.nseg - self.nseg//2
+        if len(pending) < self.nseg:
+            self.pending = pending
+            return
+        nsegs = (len(pending) - self.nseg) // hop + 1
+
+        # (segment, time, variable) view of the overlapping segments
+        segments = as_strided(pending, shape=(nsegs, self.nseg, pending.shape[1]),
+                              strides=(hop*pending.strides[0],) + pending.strides)
+        segments = segments - segments.mean(axis=1)[:,None,:]
+        if self.detrend == 'linear':
+            t = np.arange(self.nseg) - 0.5*(self.nseg - 1)
+            slopes = np.einsum('i,kij->kj', t, segments) / np.dot(t, t)
+            segments -= slopes[:,None,:] * t[None,:,None]
+
+        transforms = np.fft.rfft(segments * self.window[None,:,None], axis=1)
+        self.periodograms += (transforms.real**2 + transforms.imag**2).sum(axis=0)
+        self.nsegments += nsegs
+
+        self.pending = pending[nsegs*hop:].copy()
+
+        return
+
+    def _add_products(self, values):
+        """ Add the products of 'values' with themselves and the rows before
+            them, at each lag, using FFTs """
+
+        L = self.max_lag
+        previous = np.concatenate( (self.history, values) )
+        nfft = 2**int(np.ceil(np.log2( len(previous) )))
+
+        # irfft(conj(fft(a)) * fft(b))[s] is the sum of a[t]*b[t+s]: with a
+        # the new rows and b the same rows with the max_lag rows before them,
+        # s = L - k gives the products of each new row with the one k before
+        new_fft = np.fft.rfft(values, nfft, axis=0)
+        previous_fft = np.fft.rfft(previous, nfft, axis=0)
+
+        for p, (i, j) in enumerate(self.products):
+            # y following x
+            sums = np.fft.irfft(np.conj(new_fft[:,j]) * previous_fft[:,i], nfft)
+            self.lagged[p,L:] += sums[L::-1]
+            # x following y (the same as the above for a variable with itself)
+            if i != j:
+                sums = np.fft.irfft(np.conj(new_fft[:,i]) * previous_fft[:,j], nfft)
+                self.lagged[p,:L] += sums[:L]
+
+        if L > 0:
+            self.history = previous[-L:].copy()
+
+        return
+
+    def results(self):
+        """ The results for the rows added so far (see the top of this file) """
+
+        L = self.max_lag
+        nvar = len(self.variables)
+        lags = np.arange(-L, L+1)
+
+        # Sums over the first and last k rows, for k = 0, ..., max_lag (rows
+        # before the first are zero), which aren't in the products at lag k
+        head = np.zeros( (L, nvar) )
+        head[:len(self.head)] = self.head
+        first = np.concatenate( (np.zeros((1, nvar)), np.cumsum(head, axis=0)) )
+        first_squares = np.concatenate( (np.zeros((1, nvar)), np.cumsum(head**2, axis=0)) )
+        last = np.concatenate( (np.zeros((1, nvar)), np.cumsum(self.history[::-1], axis=0)) )
+        last_squares = np.concatenate( (np.zeros((1, nvar)), np.cumsum(self.history[::-1]**2, axis=0)) )
+
+        # Covariance and variances of the x(t) and y(t + lag) paired at each
+        # lag, each about their own mean, so that a drift in the simulation
+        # doesn't change the correlations
+        counts = (self.n - np.abs(lags)).astype(float)
+        counts[counts < 2] = np.nan
+        stats = []
+        for p, (i, j) in enumerate(self.products):
+            lagged = self.lagged[p].copy()
+            if i == j:
+                lagged[:L] = lagged[:L:-1]
+
+            # y following x: x leaves out the last k rows, y the first k
+            k = np.abs(lags)
+            following = lags >= 0
+            sum_x = self.sums[i] - np.where(following, last[k,i], first[k,i])
+            sum_y = self.sums[j] - np.where(following, first[k,j], last[k,j])
+            squares_x = self.squares[i] - np.where(following, last_squares[k,i], first_squares[k,i])
+            squares_y = self.squares[j] - np.where(following, first_squares[k,j], last_squares[k,j])
+
+            with np.errstate(all='ignore'):
+                covariance = lagged/counts - sum_x*sum_y/counts**2
+                variance_x = squares_x/counts - (sum_x/counts)**2
+                variance_y = squares_y/counts - (sum_y/counts)**2
+                stats.append( (covariance / variance_x, covariance / np.sqrt(variance_x*variance_y)) )
+
+        with np.errstate(all='ignore'):
+            means = self.sums / self.n
+            variance = self.squares / self.n - means**2
+
+        # Power spectral density, one sided (not doubled at zero and the Nyquist frequency)
+        freq = np.fft.rfftfreq(self.nseg, self.step / YEAR)
+        if self.nsegments > 0:
+            scale = 2. * self.step/YEAR / (self.nsegments * np.sum(self.window**2))
+            power = self.periodograms.T * scale
+            power[:,0] /= 2
+            if self.nseg % 2 == 0:
+                power[:,-1] /= 2
+        else:
+            power = np.full( (nvar, len(freq)), np.nan )
+
+        return {'variables': np.array(self.variables),
+                'pairs': np.array(self.pairs).reshape(-1, 2),
+                'freq': freq,
+                'power': power,
+                'lags': lags * self.step/YEAR,
+                'autocorr': np.array( [stats[i][1][L:] for i in range(nvar)] ).reshape(nvar, L+1),
+                'regression': np.array( [regression for regression, correlation in stats[nvar:]] ).reshape(-1, 2*L+1),
+                'correlation': np.array( [correlation for regression, correlation in stats[nvar:]] ).reshape(-1, 2*L+1),
+                'mean': means + (self.offset if self.offset is not None else 0.),
+                'variance': variance,
+                'nsamples': self.n,
+                'nsegments': self.nsegments,
+                'step': self.step}
+
+
+def _array_chunks(arr, first, last, rows):
+    """ Rows first, ..., last-1 of a (memory-mapped) array, 'rows' at a time """
+    for start in range(first, last, rows):
+        yield np.array(arr[start:min(start+rows, last)])
+
+
+def _text_chunks(paths, first, last, rows):
+    """ Rows first, ..., last-1 of the text files 'paths' side by side, 'rows'
+        at a time. Lines starting with '#' (headers) are skipped. """
+
+    files = [itertools.islice( (line for line in open(path) if not line.startswith('#')), first, last )
+             for path in paths]
+    while True:
+        blocks = [list(itertools.islice(f, rows)) for f in files]
+        if not blocks[0]:
+            return
+        yield np.hstack( [np.fromstring(''.join(block), sep=' ').reshape(len(block), -1) for block in blocks] )
+
+
+def read_chunks(loc, years=None, rows=chunk_rows):
+    """ The output of the simulation saved in 'loc', a chunk at a time.
+
+        Returns the names of the columns of its state array, the time between
+        rows (s), and a generator of the rows in 'years' ((first, last)
+        simulation years, either of which may be None), 'rows' at a time. """
+
+    if os.path.exists(loc+"state.npy") or os.path.exists(loc+"nbox.npy"):
+        fname = "state.npy" if os.path.exists(loc+"state.npy") else "nbox.npy"
+        state = np.load(loc+fname, mmap_mode='r')
+        columns = nbox.state_columns(2 if fname == "state.npy" else (state.shape[1] + 3) // 12)
+        time = state[:2, columns.index('glob.time' if fname == "state.npy" else 'time')]
+        first, last = plot.rows_in(years, time[0], time[1] - time[0], len(state))
+        return columns, time[1] - time[0], _array_chunks(state, first, last, rows)
+
+    if os.path.exists(loc+"prognostic.npz"):
+        saved = np.load(loc+"prognostic.npz")
+        step = float(saved['dt'])
+        first, last = plot.rows_in(years, 0., step, len(saved['prognostic']))
+        return nbox.state_columns(2), step, model.prognostic_chunks(loc+"prognostic.npz", rows, first, last)
+
+    if os.path.exists(loc+"nbox.out"):
+        paths = [loc+"nbox.out"]
+        header = open(paths[0]).readline()
+        columns = header.lstrip('#').split()
+        nrows = sum(1 for line in open(paths[0]) if not line.startswith('#'))
+    else:
+        paths = [loc+"box1.out", loc+"box2.out", loc+"global.out"]
+        columns = nbox.state_columns(2)
+        nrows = sum(1 for line in open(paths[2]))
+
+    time = next(_text_chunks(paths, 0, 2, 2))[:, columns.index('glob.time' if len(paths) == 3 else 'time')]
+    first, last = plot.rows_in(years, time[0], time[1] - time[0], nrows)
+
+    return columns, time[1] - time[0], _text_chunks(paths, first, last, rows)
+
+
+def analyse(loc, years=None, variables=None, pairs=None):
+    """ Analyse the simulation saved in 'loc' over 'years' (see read_chunks).
+        By default the variables and pairs are those in the settings above.
+        Returns the results (see the top of this file). """
+
+    columns, step, chunks = read_chunks(loc, years)
+    default = default_variables(columns)
+
+    variability = Variability(columns, step, default[0] if variables is None else variables,
+                              default[1] if pairs is None else pairs)
+    for rows in chunks:
+        variability.add(rows)
+
+    return variability.results()
+
+
+def record(every=chunk_rows, path=None):
+    """ Analyse the simulation as it runs (see hooks.py): the rows calculated
+        are added every 'every' steps, and the results are saved to 'path'
+        (save_loc/variability.npz by default) at the end. Returns the Variability. """
+
+    if path is None:
+        path = save_loc + results_file
+
+    columns = nbox.state_columns()
+    variability = Variability(columns, dt, *default_variables(columns))
+
+    # The dictionaries of the data are views of the state array (see model.initialise)
+    def add_rows(n, *data):
+        variability.add( data[0]['Ta'].base[variability.n:n+1] )
+
+    def save(n, *data):
+        add_rows(n, *data)
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        write_array(path, variability.results())
+        print "Saved the variability of the simulation to %s" %path
+
+    hooks.every(every, add_rows)
+    hooks.at_end(save)
+
+    return variability
+
+
+def summary(results):
+    """ Lines summarising the results: the standard deviation, decorrelation
+        time and period of the largest spectral peak of each variable, and the
+        largest lag correlation of each pair """
+
+    lags = results['lags'][results['lags'] >= 0]
+    lines = ["%d years, %d segments of the spectra" %(round(results['nsamples'] * results['step'] / YEAR),
+                                                      results['nsegments']),
+             "%-10s %12s %12s %18s %16s" %("variable", "mean", "std. dev.", "decorrelation (y)", "peak period (y)")]
+
+    for k, name in enumerate(results['variables']):
+        # First lag the autocorrelation drops below 1/e
+        below = np.nonzero(results['autocorr'][k] < np.exp(-1))[0]
+        decorrelation = "%.3g" %lags[below[0]] if len(below) else "> %g" %lags[-1]
+        # Largest peak of the spectrum, apart from at zero frequency
+        power = results['power'][k][1:]
+        peak = "%.3g" %(1. / results['freq'][1:][np.argmax(power)]) if np.isfinite(power).all() else "-"
+        lines.append( "%-10s %12.5g %12.3g %18s %16s" %(name, results['mean'][k], np.sqrt(results['variance'][k]),
+                                                        decorrelation, peak) )
+
+    if len(results['pairs']):
+        lines.append( "\n%-22s %14s %9s %14s" %("pair (x, y)", "correlation", "lag (y)", "regression") )
+        for p, (x, y) in enumerate(results['pairs']):
+            k = np.argmax(np.abs(results['correlation'][p]))
+            lines.append( "%-22s %14.3f %9.3g %14.3g" %("%s, %s" %(x, y), results['correlation'][p][k],
+                                                        results['lags'][k], results['regression'][p][k]) )
+
+    return lines
+
+
+if __name__ == "__main__":
+
+    loc, years = save_loc, None
+    for arg in argv[1:]:
+        if arg.startswith('years='):
+            years = plot.years_arg(arg)
+        else:
+            loc = arg if arg.endswith('/') else arg+'/'
+
+    results = analyse(loc, years)
+    print "\n".join(summary(results))
+
+    write_array(loc + results_file, results)
+    print "\nSaved %s%s" %(loc, results_file)
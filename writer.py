@@ -0,0 +1,103 @@
+import os
+import atexit
+import threading
+import Queue
+import numpy as np
+
+
+def write_array(path, arr, header=''):
+    """ Write an array to 'path', in binary if it ends in .npy, otherwise as text
+        with an optional header line. If 'path' ends in .npz, 'arr' is a dictionary
+        of arrays. The data is flushed to disk before returning. """
+
+    f = open(path, 'wb')
+    try:
+        if path.endswith(".npy"):
+            np.save(f, arr)
+        elif path.endswith(".npz"):
+            np.savez(f, **arr)
+        else:
+            np.savetxt(f, arr, header=header)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+    return
+
+
+class BackgroundWriter(object):
+    """ Writes arrays to files in background threads, so that the simulation
+        can carry on while its time series are being saved.
+
+        Each file gets its own thread, so different files are written at the
+        same time while successive saves to the same file stay in order.
+        Each thread has a queue of at most 'maxsize' saves waiting: if the
+        writing falls that far behind, write() waits for it to catch up.
+
+        The arrays are not copied, so they mustn't be modified until they've
+        been written. Call close() to wait for everything to be written. """
+
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self.queues = {}
+        self.threads = []
+        self.errors = []
+        self.nwritten = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # Don't lose data if close() isn't called
+        atexit.register(self.close)
+
+    def write(self, path, arr, header=''):
+        """ Queue 'arr' to be written to 'path' (see write_array) """
+
+        if self.closed:
+            raise ValueError("BackgroundWriter has been closed")
+
+        if path not in self.queues:
+            self.queues[path] = Queue.Queue(self.maxsize)
+            thread = threading.Thread(target=self._run, args=(self.queues[path],))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        self.queues[path].put( (path, arr, header) )
+
+        return
+
+    def _run(self, queue):
+        """ Write everything from 'queue' until sent None """
+
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+
+            path, arr, header = item
+            try:
+                write_array(path, arr, header)
+                with self.lock:
+                    self.nwritten += 1
+            except Exception as e:
+                with self.lock:
+                    self.errors.append( (path, e) )
+
+    def close(self):
+        """ Wait for all queued arrays to be written. Raises IOError if any
+            of them couldn't be. """
+
+        if self.closed:
+            return
+        self.closed = True
+
+        for queue in self.queues.values():
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if self.errors:
+            raise IOError("Failed to save " + ", ".join("%s (%s)" %(path, e) for path, e in self.errors))
+
+        return